@@ -0,0 +1,199 @@
+import asyncio
+import gzip
+import json
+import os
+from datetime import date
+
+from database import DB_PATH, TIMER_STATS_TABLES, timer_stats_merge_statement
+
+# Finished timers that started before the first of the month this many
+# months back are moved out of tbl_timers into the archive. 0 keeps
+# everything in tbl_timers.
+TIMER_RETENTION_MONTHS = int(os.environ.get("MEMOTIME_TIMER_RETENTION_MONTHS", 0))
+ARCHIVE_DIR = os.environ.get("MEMOTIME_ARCHIVE_DIR", os.path.join(os.path.dirname(DB_PATH), "archive"))
+# Timers moved per write. A move holds the writer thread while it runs.
+ARCHIVE_CHUNK_SIZE = int(os.environ.get("MEMOTIME_ARCHIVE_CHUNK_SIZE", 10000))
+# Seconds between looks for timers past the retention period
+ARCHIVE_INTERVAL = float(os.environ.get("MEMOTIME_ARCHIVE_INTERVAL", 3600))
+ARCHIVE_COMPRESSION_LEVEL = 6
+
+ARCHIVE_COLUMNS = ["id", "task_name", "start_time", "end_time", "duration"]
+
+OLDEST_EXPIRED_QUERY = """
+    SELECT substr(start_time, 1, 7) FROM tbl_timers
+    WHERE start_time < ? AND end_time IS NOT NULL
+    ORDER BY start_time LIMIT 1
+"""
+
+EXPIRED_CHUNK_QUERY = f"""
+    SELECT {', '.join(ARCHIVE_COLUMNS)} FROM tbl_timers
+    WHERE start_time >= ? AND start_time < ? AND end_time IS NOT NULL
+    ORDER BY start_time, id LIMIT ?
+"""
+
+CHUNK_IDS = "SELECT value FROM json_each(?)"
+
+# A part overlaps [start, end] when it neither ends before start nor
+# begins after end
+ARCHIVE_PARTS_QUERY = """
+    SELECT file FROM tbl_timer_archive
+    WHERE first_start <= ? AND last_start >= ?
+    ORDER BY first_start, id
+"""
+
+ARCHIVE_MONTHS_QUERY = """
+    SELECT month, COUNT(*), SUM(row_count), SUM(bytes), MIN(first_start), MAX(last_start)
+    FROM tbl_timer_archive
+    GROUP BY month
+    ORDER BY month
+"""
+
+
+def retention_cutoff(months, today=None):
+    # The first day of the month `months` before today's, as a start_time
+    # prefix: every timer that started earlier is past retention
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1 - months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}-01"
+
+
+def next_month(month):
+    year, number = map(int, month.split("-"))
+    return f"{year + number // 12:04d}-{number % 12 + 1:02d}-01"
+
+
+def chunk_stats_query(spec):
+    # The chunk's share of a stats table, in timer_stats_merge_statement order
+    values = ", ".join(value.format(row="tbl_timers") for value in spec["values"])
+    return f"""
+        SELECT {values}, COUNT(*), SUM(duration), MIN(duration), MAX(duration), SUM(duration * duration)
+        FROM tbl_timers WHERE id IN ({CHUNK_IDS}) AND duration IS NOT NULL
+        GROUP BY {values}
+    """
+
+
+# Month-partitioned cold storage for timers. A move takes up to chunk_size
+# finished timers from the oldest month past retention and writes them,
+# ordered by start_time, to one gzipped JSON part file. In the same
+# transaction it deletes them from tbl_timers, records the part in
+# tbl_timer_archive and drops their tbl_changes entries, so sync clients
+# keep the copies they have rather than being told to delete them. The
+# aggregate tables keep counting archived timers. Part files are written
+# once and never changed; a timer added later to an archived month simply
+# ends up in another part of that month.
+#
+# Readers find the parts that overlap a start_time range through
+# tbl_timer_archive and decompress only those. The file is in place before
+# its row commits, so a part listed in a snapshot can always be read.
+class TimerArchive:
+    def __init__(
+        self,
+        directory=ARCHIVE_DIR,
+        retention_months=TIMER_RETENTION_MONTHS,
+        chunk_size=ARCHIVE_CHUNK_SIZE,
+    ):
+        self.directory = directory
+        self.retention_months = retention_months
+        self.chunk_size = chunk_size
+        self.runs = 0
+        self.moved = 0
+        self.last_error = None
+
+    def archive_chunk(self, db, cutoff, written):
+        # A write function: moves one chunk and returns its size, 0 once
+        # nothing started before cutoff is left. Paths of files it creates
+        # go into `written` so the caller can remove them if the group fails
+        # to commit.
+        row = db.execute(OLDEST_EXPIRED_QUERY, (cutoff,)).fetchone()
+        if row is None:
+            return 0
+        month = row[0]
+        rows = db.execute(EXPIRED_CHUNK_QUERY, (f"{month}-01", next_month(month), self.chunk_size)).fetchall()
+        ids = json.dumps([row[0] for row in rows])
+        file = f"timers-{month}-{min(row[0] for row in rows)}.json.gz"
+        size = self._write_part(file, rows, written)
+        shares = {table: db.execute(chunk_stats_query(spec), (ids,)).fetchall() for table, spec in TIMER_STATS_TABLES.items()}
+        # The archived share goes in first so the delete triggers see it when
+        # they look for a group's new minimum or maximum
+        for table, spec in TIMER_STATS_TABLES.items():
+            db.executemany(timer_stats_merge_statement(spec["archived"], spec), shares[table])
+        db.execute(f"DELETE FROM tbl_timers WHERE id IN ({CHUNK_IDS})", (ids,))
+        for table, spec in TIMER_STATS_TABLES.items():
+            db.executemany(timer_stats_merge_statement(table, spec), shares[table])
+        db.execute(f"DELETE FROM tbl_changes WHERE entity = 'timer' AND entity_id IN ({CHUNK_IDS})", (ids,))
+        db.execute(
+            "INSERT INTO tbl_timer_archive (month, file, first_start, last_start, row_count, bytes) VALUES (?, ?, ?, ?, ?, ?)",
+            (month, file, rows[0][2], rows[-1][2], len(rows), size),
+        )
+        return len(rows)
+
+    def _write_part(self, file, rows, written):
+        data = gzip.compress(
+            json.dumps({"columns": ARCHIVE_COLUMNS, "rows": rows}, separators=(",", ":")).encode(),
+            ARCHIVE_COMPRESSION_LEVEL,
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, file)
+        with open(path + ".tmp", "wb") as out:
+            out.write(data)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(path + ".tmp", path)
+        written.append(path)
+        return len(data)
+
+    async def archive_expired(self, database):
+        # Moves everything past retention, one chunk per write so other
+        # writes get in between. Returns how many timers moved.
+        cutoff = retention_cutoff(self.retention_months)
+        moved = 0
+        while True:
+            written = []
+            try:
+                count = await database.write(self.archive_chunk, cutoff, written)
+            except Exception:
+                for path in written:
+                    os.remove(path)
+                raise
+            self.moved += count
+            if not count:
+                return moved
+            moved += count
+
+    async def run(self, database, interval=ARCHIVE_INTERVAL):
+        # Background task. A failed pass is recorded and retried next time.
+        while True:
+            try:
+                await self.archive_expired(database)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = repr(e)
+            self.runs += 1
+            await asyncio.sleep(interval)
+
+    def parts(self, db, start, end):
+        # Part files that may hold timers with start_time in [start, end]
+        return [row[0] for row in db.execute(ARCHIVE_PARTS_QUERY, (end, start))]
+
+    def read(self, file, start, end):
+        # Timers of one part with start time in [start, end], compared as
+        # text the way SQLite compares start_time
+        with open(os.path.join(self.directory, file), "rb") as part:
+            rows = json.loads(gzip.decompress(part.read()))["rows"]
+        return [row for row in rows if row[2] is not None and start <= row[2] <= end]
+
+    def months(self, db):
+        return [
+            dict(zip(("month", "parts", "rows", "bytes", "first_start", "last_start"), row))
+            for row in db.execute(ARCHIVE_MONTHS_QUERY)
+        ]
+
+    def status(self):
+        return {
+            "retention_months": self.retention_months,
+            "directory": os.path.abspath(self.directory),
+            "chunk_size": self.chunk_size,
+            "runs": self.runs,
+            "moved": self.moved,
+            "last_error": self.last_error,
+        }
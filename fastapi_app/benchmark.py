@@ -0,0 +1,778 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# --output and compare's files are relative to where the command was run
+CALLER_DIR = os.getcwd()
+sys.path.insert(0, APP_DIR)
+if __name__ == "__main__":
+    # The command runs against a scratch database so the real memotime.db is
+    # never touched. It is set up here, before main reads MEMOTIME_DB_PATH,
+    # and only in the command itself: load-test children started with spawn
+    # import this module again under another name, and get the scratch path
+    # from the environment they inherit. Servers are handed it explicitly.
+    os.chdir(tempfile.mkdtemp(prefix="memotime-bench-"))
+    os.environ["MEMOTIME_DB_PATH"] = os.path.join(os.getcwd(), "memotime.db")
+
+import httpx
+from fastapi.encoders import jsonable_encoder
+from fastapi import Response
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+import database
+import main
+from mutations import MUTATION_CHUNK_SIZE
+
+
+class UnpooledConnections:
+    # The pre-pool behaviour: a fresh connection per request
+    def acquire(self):
+        return database.register_functions(sqlite3.connect(main.DB_PATH, check_same_thread=False))
+
+    def release(self, db):
+        db.close()
+
+
+WORDS = (
+    "meeting project budget review design sprint release customer invoice travel "
+    "groceries workout reading planning research draft feedback deadline call email "
+    "report launch bug fix refactor database cache index query server client mobile"
+).split()
+
+
+def random_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def seed_notes(rows, seed=0, chunk=10000):
+    rng = random.Random(seed)
+    db = database.register_functions(sqlite3.connect(main.DB_PATH))
+    for start in range(0, rows, chunk):
+        db.executemany(
+            main.INSERT_NOTE_QUERY,
+            (
+                (random_text(rng, 4), f"{random_text(rng, 40)} ref{rng.randrange(rows)}")
+                for _ in range(min(chunk, rows - start))
+            ),
+        )
+        db.commit()
+    db.close()
+
+
+def seed_timers(rows, seed=0, chunk=10000):
+    # Spread over 2024 across the WORDS task names, up to two hours each
+    rng = random.Random(seed)
+    year = 366 * 24 * 3600
+    db = sqlite3.connect(main.DB_PATH)
+    for start in range(0, rows, chunk):
+        batch = []
+        for _ in range(min(chunk, rows - start)):
+            offset, duration = rng.randrange(year), rng.randrange(60, 7200)
+            started = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(1704067200 + offset))
+            ended = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(1704067200 + offset + duration))
+            batch.append((rng.choice(WORDS), started, ended, duration))
+        db.executemany(main.INSERT_TIMER_QUERY, batch)
+        db.commit()
+    db.close()
+
+
+def latency_ms(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return {"p50_ms": statistics.median(samples), "max_ms": max(samples)}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def start_server(workers=1, env=None):
+    # A real uvicorn process, so client and server do not share a GIL
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env={**os.environ, "PYTHONPATH": APP_DIR, "MEMOTIME_DB_PATH": main.DB_PATH, **(env or {})},
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{url}/notes/count/")
+            return server, url
+        except httpx.TransportError:
+            time.sleep(0.02)
+    server.kill()
+    raise RuntimeError("uvicorn did not start")
+
+
+async def client_load(url, concurrency, seconds, note_ids, first_seed):
+    # Mixed workload: 80% single-note reads, 10% recent notes, 10% creates
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        deadline = time.monotonic() + seconds
+
+        async def worker(seed):
+            nonlocal errors
+            rng = random.Random(seed)
+            while time.monotonic() < deadline:
+                roll = rng.random()
+                started = time.perf_counter()
+                try:
+                    if roll < 0.8:
+                        response = await client.get(f"/notes/{rng.choice(note_ids)}")
+                    elif roll < 0.9:
+                        response = await client.get("/notes/recent/")
+                    else:
+                        response = await client.post("/notes/", json={"title": "load", "content": random_text(rng, 20)})
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        await asyncio.gather(*(worker(first_seed + seed) for seed in range(concurrency)))
+    return latencies, errors
+
+
+def load_process(url, concurrency, seconds, note_ids, first_seed, ready, results):
+    # One client process of run_load; starts with the others at the barrier
+    ready.wait()
+    results.put(asyncio.run(client_load(url, concurrency, seconds, note_ids, first_seed)))
+
+
+def run_load(url, concurrency, seconds, note_ids, processes):
+    # The clients are spread over several processes, so a single client
+    # event loop and its GIL do not cap the rate the server sees
+    processes = max(1, min(processes, concurrency))
+    ready = multiprocessing.Barrier(processes)
+    results = multiprocessing.Queue()
+    shares = [concurrency // processes + (index < concurrency % processes) for index in range(processes)]
+    clients = [
+        multiprocessing.Process(
+            target=load_process, args=(url, share, seconds, note_ids, sum(shares[:index]), ready, results)
+        )
+        for index, share in enumerate(shares)
+    ]
+    for client in clients:
+        client.start()
+    # Drained before joining, as a child does not exit until its put is read
+    outcomes = [results.get() for _ in clients]
+    for client in clients:
+        client.join()
+    latencies = [latency for samples, _ in outcomes for latency in samples]
+    return {
+        "processes": processes,
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in outcomes),
+        "requests_per_second": len(latencies) / seconds,
+        "p50_ms": percentile(latencies, 0.50) if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) if latencies else None,
+    }
+
+
+def bench_load(args):
+    seed_notes(args.rows)
+    note_ids = list(range(1, args.rows + 1))
+    server, url = start_server()
+    try:
+        return {
+            concurrency: run_load(url, concurrency, args.seconds, note_ids, args.processes)
+            for concurrency in args.concurrency
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def requests_per_second(client, method, url, requests, **kwargs):
+    started = time.perf_counter()
+    for _ in range(requests):
+        response = client.request(method, url, **kwargs)
+        response.raise_for_status()
+    return requests / (time.perf_counter() - started)
+
+
+def bench_pool(args):
+    # Only reads go through the pool. Writes run on the single writer's own
+    # connection either way, so they are left to the writes benchmark.
+    results = {"writes": "not pooled; see benchmark.py writes"}
+    with TestClient(main.app) as client:
+        client.post("/notes/", json={"title": "benchmark", "content": "x" * 200})
+        note_id = client.get("/notes/").json()[0]["id"]
+        pool = main.database.pool
+        for mode in ("unpooled", "pooled"):
+            main.database.pool = UnpooledConnections() if mode == "unpooled" else pool
+            results[mode] = {
+                "GET /notes/{note_id}": requests_per_second(client, "GET", f"/notes/{note_id}", args.requests),
+            }
+    return results
+
+
+def bench_search(args):
+    seed_notes(args.rows)
+    db = main.database.pool.acquire()
+    results = {}
+    try:
+        # A rare reference word and a common title word
+        for term in ("ref4242", "budget"):
+            like = lambda: db.execute(
+                "SELECT * FROM v_notes WHERE title LIKE ? OR content LIKE ?", (f"%{term}%", f"%{term}%")
+            ).fetchall()
+            match = main.build_fts_query(term)
+            params = dict(highlight_start="[", highlight_end="]", snippet_words=12, match=match, limit=20, offset=0)
+            fts = lambda: db.execute(main.SEARCH_QUERY, params).fetchall()
+            results[term] = {"like": latency_ms(like, args.repeat), "fts": latency_ms(fts, args.repeat)}
+    finally:
+        main.database.pool.release(db)
+    return {"rows": args.rows, "queries": results}
+
+
+def bench_bulk(args):
+    rng = random.Random(0)
+    results = {}
+    with TestClient(main.app) as client:
+        for rows in args.scales:
+            notes = "\n".join(
+                json.dumps({"title": random_text(rng, 4), "content": random_text(rng, 40)}) for _ in range(rows)
+            )
+            timers = "\n".join(
+                json.dumps({
+                    "task_name": rng.choice(WORDS),
+                    "start_time": f"2024-01-{rng.randrange(1, 29):02d}T{rng.randrange(0, 12):02d}:00:00",
+                    "end_time": f"2024-01-29T{rng.randrange(12, 24):02d}:00:00",
+                })
+                for _ in range(rows)
+            )
+            results[rows] = {}
+            for url, body in (("/notes/bulk", notes), ("/timers/bulk", timers)):
+                started = time.perf_counter()
+                response = client.post(url, content=body, headers={"content-type": "application/x-ndjson"})
+                elapsed = time.perf_counter() - started
+                response.raise_for_status()
+                assert response.json()["created"] == rows
+                results[rows][url] = {"seconds": elapsed, "rows_per_second": rows / elapsed}
+    return results
+
+
+def cpu_ms_per_100k(fn, rows, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.process_time()
+        fn()
+        samples.append((time.process_time() - started) * 1000 * 100_000 / rows)
+    return statistics.median(samples)
+
+
+def bench_serialize(args):
+    seed_notes(args.rows)
+    db = main.database.pool.acquire()
+    try:
+        notes = db.execute(f"SELECT {', '.join(main.NOTE_COLUMNS)} FROM v_notes").fetchall()
+    finally:
+        main.database.pool.release(db)
+    rng = random.Random(0)
+    timers = [
+        (index, rng.choice(WORDS), "2024-01-01 09:00:00", "2024-01-01 10:30:00", 5400)
+        for index in range(1, args.rows + 1)
+    ]
+    results = {}
+    for name, columns, rows in (("notes", main.NOTE_COLUMNS, notes), ("timers", main.TIMER_COLUMNS, timers)):
+        # What FastAPI does with a returned list of dicts
+        generic = lambda: JSONResponse(jsonable_encoder([dict(zip(columns, row)) for row in rows])).body
+        fast = lambda: main.rows_response(columns, rows, Response()).body
+        results[name] = {
+            "generic_cpu_ms_per_100k_rows": cpu_ms_per_100k(generic, len(rows), args.repeat),
+            "fast_cpu_ms_per_100k_rows": cpu_ms_per_100k(fast, len(rows), args.repeat),
+        }
+    return {"rows": args.rows, "serializers": results}
+
+
+def bench_stats(args):
+    seed_timers(args.rows)
+    windows = {"month": ("2024-03-01T00:00:00", "2024-04-01T00:00:00"), "year": ("2024-01-01T00:00:00", "2025-01-01T00:00:00")}
+    variants = {
+        "overall": {},
+        "by_task": {"by_task": True},
+        "daily_by_task": {"bucket": "day", "by_task": True},
+        "hourly": {"bucket": "hour"},
+        "weekly_one_task": {"bucket": "week", "task_name": "budget"},
+        # Served from the daily rollup alone
+        "by_task_no_percentiles": {"by_task": True, "percentiles": False},
+        "daily_by_task_no_percentiles": {"bucket": "day", "by_task": True, "percentiles": False},
+    }
+    results = {}
+    with TestClient(main.app) as client:
+        for window, (start, end) in windows.items():
+            for name, params in variants.items():
+                params = {"start": start, "end": end, **params}
+                get = lambda: client.get("/timers/stats/", params=params).raise_for_status()
+                results[f"{window}/{name}"] = latency_ms(get, args.repeat)
+    return {"rows": args.rows, "queries": results}
+
+
+async def concurrent_creates(writes, concurrency):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://memotime") as client:
+        pending = iter(range(writes))
+
+        async def worker():
+            for _ in pending:
+                response = await client.post("/notes/", json={"title": "benchmark", "content": "x" * 200})
+                response.raise_for_status()
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+def bench_writes(args):
+    # POST /notes/ throughput at each concurrency, with and without the
+    # writer waiting for a group to fill
+    results = {}
+    with TestClient(main.app) as client:
+        for delay in sorted({0.0, 0.002, main.database.write_batch_delay}):
+            main.database.write_batch_delay = delay
+            for concurrency in args.concurrency:
+                main.database.write_stats = database.WriteStats()
+                started = time.perf_counter()
+                client.portal.call(concurrent_creates, args.requests, concurrency)
+                elapsed = time.perf_counter() - started
+                stats = main.database.stats()
+                results[f"delay_{delay * 1000:g}ms/concurrency_{concurrency}"] = {
+                    "writes_per_second": args.requests / elapsed,
+                    "mean_group_size": stats["mean_group_size"],
+                    "mean_commit_ms": stats["mean_commit_ms"],
+                    "max_queue_wait_ms": stats["max_queue_wait_ms"],
+                }
+    return results
+
+
+# Every endpoint except POST /metrics/profiler/, which changes server
+# settings, and GET /events, which holds its connection open. Each entry is
+# (weight in the mixed workload, request builder). Builders get an RNG and
+# the seeded row count and return (method, url, httpx keyword arguments).
+def timer_body(rng):
+    day = rng.randrange(1, 29)
+    return {"task_name": rng.choice(WORDS), "start_time": f"2024-02-{day:02d}T09:00:00", "end_time": f"2024-02-{day:02d}T10:30:00"}
+
+
+def note_body(rng):
+    return {"title": random_text(rng, 4), "content": random_text(rng, 40)}
+
+
+def some_day(rng):
+    return f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+
+
+ENDPOINTS = {
+    "GET /notes/": (10, lambda rng, rows: ("GET", "/notes/", {"params": {"limit": 100}})),
+    "GET /notes/?order=updated_at": (2, lambda rng, rows: ("GET", "/notes/", {"params": {"limit": 100, "order": "updated_at"}})),
+    "GET /notes/?fields=id,title,updated_at": (
+        5, lambda rng, rows: ("GET", "/notes/", {"params": {"limit": 100, "fields": "id,title,updated_at"}}),
+    ),
+    "GET /notes/{note_id}": (30, lambda rng, rows: ("GET", f"/notes/{rng.randrange(1, rows + 1)}", {})),
+    "GET /notes/search/": (5, lambda rng, rows: ("GET", "/notes/search/", {"params": {"q": rng.choice(WORDS)}})),
+    "GET /notes/count/": (3, lambda rng, rows: ("GET", "/notes/count/", {})),
+    "GET /notes/recent/": (5, lambda rng, rows: ("GET", "/notes/recent/", {})),
+    "POST /notes/": (5, lambda rng, rows: ("POST", "/notes/", {"json": note_body(rng)})),
+    "PUT /notes/{note_id}": (3, lambda rng, rows: ("PUT", f"/notes/{rng.randrange(1, rows + 1)}", {"json": note_body(rng)})),
+    "DELETE /notes/{note_id}": (1, lambda rng, rows: ("DELETE", f"/notes/{rng.randrange(1, rows + 1)}", {})),
+    "DELETE /notes/bulk-delete/": (
+        1, lambda rng, rows: ("DELETE", "/notes/bulk-delete/", {"json": [rng.randrange(1, rows + 1) for _ in range(3)]}),
+    ),
+    "POST /notes/bulk": (1, lambda rng, rows: ("POST", "/notes/bulk", {"json": [note_body(rng) for _ in range(10)]})),
+    "PATCH /notes/bulk-update/": (
+        1, lambda rng, rows: (
+            "PATCH", "/notes/bulk-update/",
+            {"json": {"where": {"ids": [rng.randrange(1, rows + 1) for _ in range(3)]}, "set": {"title": random_text(rng, 4)}}},
+        ),
+    ),
+    "GET /timers/": (5, lambda rng, rows: ("GET", "/timers/", {"params": {"limit": 100}})),
+    "GET /timers/{timer_id}": (10, lambda rng, rows: ("GET", f"/timers/{rng.randrange(1, rows + 1)}", {})),
+    "POST /timers/": (3, lambda rng, rows: ("POST", "/timers/", {"json": timer_body(rng)})),
+    "PUT /timers/{timer_id}": (2, lambda rng, rows: ("PUT", f"/timers/{rng.randrange(1, rows + 1)}", {"json": timer_body(rng)})),
+    "DELETE /timers/{timer_id}": (1, lambda rng, rows: ("DELETE", f"/timers/{rng.randrange(1, rows + 1)}", {})),
+    "POST /timers/bulk": (1, lambda rng, rows: ("POST", "/timers/bulk", {"json": [timer_body(rng) for _ in range(10)]})),
+    "DELETE /timers/bulk-delete/": (
+        1, lambda rng, rows: ("DELETE", "/timers/bulk-delete/", {"json": [rng.randrange(1, rows + 1) for _ in range(3)]}),
+    ),
+    "PATCH /timers/bulk-update/": (
+        1, lambda rng, rows: (
+            "PATCH", "/timers/bulk-update/",
+            {"json": {"where": {"ids": [rng.randrange(1, rows + 1) for _ in range(3)]}, "set": {"task_name": rng.choice(WORDS)}}},
+        ),
+    ),
+    "POST /timers/start": (2, lambda rng, rows: ("POST", "/timers/start", {"json": {"task_name": rng.choice(WORDS)}})),
+    # Seeded timers are already stopped, so most of these answer 409
+    "POST /timers/{timer_id}/stop": (2, lambda rng, rows: ("POST", f"/timers/{rng.randrange(1, rows + 1)}/stop", {})),
+    "GET /timers/active/": (2, lambda rng, rows: ("GET", "/timers/active/", {})),
+    "GET /timers/duration/": (2, lambda rng, rows: ("GET", "/timers/duration/", {"params": {"task_name": rng.choice(WORDS)}})),
+    "GET /timers/average-duration/": (2, lambda rng, rows: ("GET", "/timers/average-duration/", {})),
+    "GET /timers/tasks/": (1, lambda rng, rows: ("GET", "/timers/tasks/", {})),
+    "GET /timers/daily/": (1, lambda rng, rows: ("GET", "/timers/daily/", {"params": {"start": "2024-03-01", "end": "2024-03-31"}})),
+    "GET /timers/range/": (
+        2, lambda rng, rows: ("GET", "/timers/range/", {"params": {"start": f"{some_day(rng)}T09:00:00", "end": f"{some_day(rng)}T10:00:00"}}),
+    ),
+    "GET /timers/stats/": (
+        1, lambda rng, rows: (
+            "GET", "/timers/stats/",
+            {"params": {"start": f"{some_day(rng)}T00:00:00", "end": "2024-12-31T00:00:00", "bucket": "week", "task_name": rng.choice(WORDS)}},
+        ),
+    ),
+    "GET /timers/archive/": (1, lambda rng, rows: ("GET", "/timers/archive/", {})),
+    "GET /sync": (2, lambda rng, rows: ("GET", "/sync", {"params": {"since": rng.randrange(2 * rows), "limit": 100}})),
+    "GET /jobs/": (1, lambda rng, rows: ("GET", "/jobs/", {})),
+    "GET /cache/stats/": (1, lambda rng, rows: ("GET", "/cache/stats/", {})),
+    "GET /database/stats/": (1, lambda rng, rows: ("GET", "/database/stats/", {})),
+    "GET /metrics": (1, lambda rng, rows: ("GET", "/metrics", {})),
+}
+# Random ids may be gone or timers already stopped; anything else is an error
+EXPECTED_STATUSES = {200, 304, 404, 409}
+
+
+def summarize(latencies, errors, seconds):
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / seconds if seconds else None,
+        "p50_ms": percentile(latencies, 0.50) if latencies else None,
+        "p99_ms": percentile(latencies, 0.99) if latencies else None,
+    }
+
+
+async def timed_request(client, name, rng, rows):
+    method, url, kwargs = ENDPOINTS[name][1](rng, rows)
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+        ok = response.status_code in EXPECTED_STATUSES
+    except httpx.HTTPError:
+        ok = False
+    return ok, (time.perf_counter() - started) * 1000
+
+
+async def drive_endpoints(client, rows, requests):
+    # Each endpoint on its own, one request at a time
+    rng = random.Random(0)
+    results = {}
+    for name in ENDPOINTS:
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for _ in range(requests):
+            ok, elapsed = await timed_request(client, name, rng, rows)
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+        results[name] = summarize(latencies, errors, time.perf_counter() - started)
+    return results
+
+
+async def drive_mixed(client, rows, concurrency, seconds):
+    # Weighted random mix of every endpoint from `concurrency` clients
+    names = list(ENDPOINTS)
+    weights = [ENDPOINTS[name][0] for name in names]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    deadline = time.monotonic() + seconds
+
+    async def worker(seed):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            name = rng.choices(names, weights)[0]
+            ok, elapsed = await timed_request(client, name, rng, rows)
+            if ok:
+                latencies[name].append(elapsed)
+            else:
+                errors[name] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(seed) for seed in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "total": summarize([value for values in latencies.values() for value in values], sum(errors.values()), elapsed),
+        "endpoints": {name: summarize(latencies[name], errors[name], elapsed) for name in names if latencies[name] or errors[name]},
+    }
+
+
+async def drive(client, args, rows):
+    return {
+        "endpoints": await drive_endpoints(client, rows, args.requests),
+        "mixed": {
+            concurrency: await drive_mixed(client, rows, concurrency, args.seconds)
+            for concurrency in args.concurrency
+        },
+    }
+
+
+async def drive_in_process(args, rows):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://memotime", timeout=60) as client:
+        return await drive(client, args, rows)
+
+
+def server_client(url, concurrency):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(base_url=url, limits=limits, timeout=60)
+
+
+async def drive_server(url, args, rows):
+    async with server_client(url, max(args.concurrency)) as client:
+        return await drive(client, args, rows)
+
+
+def reset_database():
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(main.DB_PATH + suffix):
+            os.remove(main.DB_PATH + suffix)
+    main.initialize_database()
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    # For each scale: seed that many notes and timers, then hit every
+    # endpoint in-process and through a local uvicorn
+    results = {}
+    for rows in args.scales:
+        reset_database()
+        seed_notes(rows)
+        seed_timers(rows)
+        scale = {}
+        if "in_process" in args.targets:
+            with TestClient(main.app) as client:
+                scale["in_process"] = client.portal.call(drive_in_process, args, rows)
+        if "uvicorn" in args.targets:
+            # Both runs see the same data: the in-process writes are undone
+            if scale:
+                reset_database()
+                seed_notes(rows)
+                seed_timers(rows)
+            server, url = start_server()
+            try:
+                scale["uvicorn"] = asyncio.run(drive_server(url, args, rows))
+            finally:
+                server.terminate()
+                server.wait()
+        results[rows] = scale
+    return {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "settings": {"requests": args.requests, "concurrency": args.concurrency, "seconds": args.seconds},
+        "scales": results,
+    }
+
+
+async def first_requests(url, rows, count=100):
+    # A fresh server's first single-note reads, one at a time
+    rng = random.Random(0)
+    latencies = []
+    async with server_client(url, 1) as client:
+        for _ in range(count):
+            ok, elapsed = await timed_request(client, "GET /notes/{note_id}", rng, rows)
+            latencies.append(elapsed)
+    return {"p50_ms": percentile(latencies, 0.50), "p99_ms": percentile(latencies, 0.99), "max_ms": max(latencies)}
+
+
+async def mixed_load(url, rows, concurrency, seconds):
+    async with server_client(url, concurrency) as client:
+        return (await drive_mixed(client, rows, concurrency, seconds))["total"]
+
+
+def bench_workers(args):
+    # For each --workers count, cold and with MEMOTIME_DB_PREWARM: time
+    # until uvicorn answers, the first reads after that, and throughput of
+    # the mixed workload. Seeding leaves the file in the OS cache, so the
+    # cold numbers mostly show per-connection warm-up, not disk reads.
+    results = {}
+    for mode, prewarm in (("cold", "0"), ("prewarm", "1")):
+        results[mode] = {}
+        for workers in args.workers:
+            reset_database()
+            seed_notes(args.rows)
+            seed_timers(args.rows)
+            started = time.perf_counter()
+            server, url = start_server(workers, {"MEMOTIME_DB_PREWARM": prewarm})
+            ready_ms = (time.perf_counter() - started) * 1000
+            try:
+                results[mode][workers] = {
+                    "ready_ms": ready_ms,
+                    "first_requests": asyncio.run(first_requests(url, args.rows)),
+                    "mixed": asyncio.run(mixed_load(url, args.rows, args.concurrency[0], args.seconds)),
+                }
+            finally:
+                server.terminate()
+                server.wait()
+    return results
+
+
+COMPARED_METRICS = {"p50_ms": 1, "p99_ms": 1, "requests_per_second": -1}
+
+
+async def load_until(client, rows, names, concurrency, done):
+    # Requests spread over `names` from `concurrency` clients until done is set
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+
+    async def worker(seed):
+        rng = random.Random(seed)
+        while not done.is_set():
+            name = rng.choice(names)
+            ok, elapsed = await timed_request(client, name, rng, rows)
+            if ok:
+                latencies[name].append(elapsed)
+            else:
+                errors[name] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(seed) for seed in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {name: summarize(latencies[name], errors[name], elapsed) for name in names}
+
+
+async def delete_under_load(url, rows, concurrency, seconds):
+    # The same load for `seconds` alone, then while a background job deletes
+    # every seeded note
+    names = ["GET /notes/{note_id}", "GET /notes/?fields=id,title,updated_at", "POST /notes/"]
+    async with server_client(url, concurrency + 1) as client:
+        idle = asyncio.Event()
+        asyncio.get_running_loop().call_later(seconds, idle.set)
+        before = await load_until(client, rows, names, concurrency, idle)
+        deleted = asyncio.Event()
+
+        async def delete():
+            response = await client.request(
+                "DELETE", "/notes/bulk-delete/", params={"background": True},
+                json={"updated_start": "2000-01-01T00:00:00", "updated_end": "2100-01-01T00:00:00"},
+            )
+            job = response.json()["job"]
+            while job["finished_at"] is None:
+                await asyncio.sleep(0.05)
+                job = (await client.get(f"/jobs/{job['id']}")).json()
+            deleted.set()
+            return job
+
+        job, during = await asyncio.gather(delete(), load_until(client, rows, names, concurrency, deleted))
+    return {
+        "delete": {
+            "rows": job["changed"],
+            "chunks": job["chunks"],
+            "seconds": job["seconds"],
+            "rows_per_second": job["changed"] / job["seconds"] if job["seconds"] else None,
+        },
+        "idle": before,
+        "during_delete": during,
+    }
+
+
+def bench_mutations(args):
+    # Read and write latency while a background bulk delete removes all
+    # --rows seeded notes, in chunks of the default size and as one write
+    results = {}
+    for name, chunk_size in (("chunked", MUTATION_CHUNK_SIZE), ("one_write", args.rows)):
+        reset_database()
+        seed_notes(args.rows)
+        server, url = start_server(env={"MEMOTIME_MUTATION_CHUNK_SIZE": str(chunk_size)})
+        try:
+            results[name] = asyncio.run(delete_under_load(url, args.rows, args.concurrency[0], args.seconds))
+        finally:
+            server.terminate()
+            server.wait()
+    return {"rows": args.rows, "concurrency": args.concurrency[0], "chunk_size": MUTATION_CHUNK_SIZE, "modes": results}
+
+
+def flatten(results, path=()):
+    # {"a": {"p50_ms": 1}} -> {("a", "p50_ms"): 1}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, path + (str(key),))
+        elif key in COMPARED_METRICS and value is not None:
+            yield path + (key,), value
+
+
+def bench_compare(args):
+    # Reports every latency or throughput figure in --candidate that is
+    # worse than --baseline by more than --tolerance
+    with open(os.path.join(CALLER_DIR, args.baseline)) as file:
+        baseline = dict(flatten(json.load(file)))
+    with open(os.path.join(CALLER_DIR, args.candidate)) as file:
+        candidate = dict(flatten(json.load(file)))
+    regressions = []
+    for path, before in baseline.items():
+        after = candidate.get(path)
+        if after is None or not before:
+            continue
+        change = (after - before) / before * COMPARED_METRICS[path[-1]]
+        if change > args.tolerance:
+            regressions.append({"metric": " > ".join(path), "baseline": before, "candidate": after, "worse_by": change})
+    regressions.sort(key=lambda regression: -regression["worse_by"])
+    return {"compared": len(baseline.keys() & candidate.keys()), "regressions": regressions}
+
+
+BENCHMARKS = {
+    "bulk": bench_bulk,
+    "compare": bench_compare,
+    "load": bench_load,
+    "mutations": bench_mutations,
+    "pool": bench_pool,
+    "search": bench_search,
+    "serialize": bench_serialize,
+    "stats": bench_stats,
+    "suite": bench_suite,
+    "workers": bench_workers,
+    "writes": bench_writes,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the memotime API")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[50, 200, 1000])
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="load: client processes")
+    parser.add_argument("--targets", nargs="+", choices=["in_process", "uvicorn"], default=["in_process", "uvicorn"])
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--baseline", help="compare: results of the earlier run")
+    parser.add_argument("--candidate", help="compare: results of the run to check")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="compare: allowed slowdown, 0.2 = 20%%")
+    args = parser.parse_args()
+    main.initialize_database()
+    results = BENCHMARKS[args.benchmark](args)
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(os.path.join(CALLER_DIR, args.output), "w") as file:
+            file.write(output + "\n")
+    # compare fails when something regressed, so it can gate a CI job
+    sys.exit(1 if results.get("regressions") else 0)
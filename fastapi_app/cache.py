@@ -0,0 +1,98 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_MAX_ENTRIES = int(os.environ.get("MEMOTIME_CACHE_MAX_ENTRIES", 1024))
+CACHE_TTL = float(os.environ.get("MEMOTIME_CACHE_TTL", 30.0))
+
+
+# In-process LRU cache with a TTL for hot read endpoints. Writers call
+# invalidate() with the keys they affect. A load in flight holds a token for
+# its key and invalidation drops that token, so a read that started before a
+# write cannot store what it loaded once the write has invalidated the key.
+# Writes in other worker processes invalidate nothing here, so an entry can
+# also carry the version of the data it was loaded from (the tbl_versions
+# counter) and only counts as a hit while that version is current.
+class ResponseCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic() and entry[2] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def _begin_load(self, key):
+        # Concurrent loads of one key share a token; the first to finish stores
+        with self._lock:
+            return self._loading.setdefault(key, object())
+
+    def _finish_load(self, key, token, value, version):
+        with self._lock:
+            if self._loading.get(key) is not token:
+                return
+            del self._loading[key]
+            if value is None:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def get_or_load(self, key, loader, version=None):
+        # None results, like a missing note, are not cached. `version` is
+        # read before the load, so a write that lands during it leaves the
+        # stored entry already out of date rather than wrongly current.
+        value = self.get(key, version)
+        if value is not None:
+            return value
+        token = self._begin_load(key)
+        value = None
+        try:
+            value = await loader()
+        finally:
+            self._finish_load(key, token, value, version)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._loading.pop(key, None)
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._loading.clear()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,975 @@
+import asyncio
+import functools
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Defaults to memotime.db beside this file, whatever directory the server is
+# started from
+DB_PATH = os.environ.get("MEMOTIME_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "memotime.db"))
+POOL_SIZE = 8
+POOL_TIMEOUT = 10.0
+# Threads dedicated to reads; each holds at most one pooled connection
+READ_WORKERS = int(os.environ.get("MEMOTIME_DB_READ_WORKERS", POOL_SIZE))
+# Most writes the writer thread groups into one transaction
+WRITE_BATCH_SIZE = int(os.environ.get("MEMOTIME_DB_WRITE_BATCH_SIZE", 64))
+# Longest the writer holds a group open for more writes to join, in seconds.
+# It bounds the latency batching adds to a write. The default, 0, takes only
+# what is queued: writes that pile up during a commit already form the next
+# group, and waiting on top of that cost throughput in `benchmark.py writes`.
+WRITE_BATCH_DELAY = float(os.environ.get("MEMOTIME_DB_WRITE_BATCH_DELAY", 0))
+# The writer fsyncs every commit, so a write is durable once acknowledged.
+# Grouping spreads that cost over the whole group.
+WRITE_SYNCHRONOUS = os.environ.get("MEMOTIME_DB_WRITE_SYNCHRONOUS", "FULL")
+
+# Pragmas applied to every pooled connection
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -20000,  # negative means KiB, so ~20 MB per connection
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+# Overrides as "name=value,name=value", e.g. "cache_size=-50000,mmap_size=0"
+PRAGMAS.update(
+    item.strip().split("=", 1) for item in os.environ.get("MEMOTIME_DB_PRAGMAS", "").split(",") if item.strip()
+)
+STATEMENT_CACHE_SIZE = 256
+# Bytes of the database file read at startup to pull it into the OS page
+# cache, when prewarming is on
+PREWARM_BYTES = int(os.environ.get("MEMOTIME_DB_PREWARM_MB", 256)) * 1024 * 1024
+# Note bodies longer than this many characters are kept zlib-compressed in
+# tbl_note_bodies, leaving tbl_notes.content NULL, so scans of tbl_notes
+# read short rows only. Migration 9 builds the limit into the v_notes
+# triggers; changing it later does not move bodies already stored.
+NOTE_INLINE_LIMIT = 1024
+NOTE_COMPRESSION_LEVEL = 6
+
+# Per-task and per-task-per-day timer aggregates. Triggers on tbl_timers keep
+# them in step with every write, in the same transaction. Running timers
+# (duration IS NULL) are left out until they get a duration. The day is the
+# date part of start_time as recorded, so day ranges line up with
+# start_time string comparisons. Each table has an "archived" twin holding
+# the share of timers moved to the archive (see archive.py).
+TIMER_STATS_TABLES = {
+    "tbl_timer_task_stats": {
+        "archived": "tbl_timer_archived_task_stats",
+        "keys": ["task_name"],
+        "values": ["{row}.task_name"],
+        "match": "task_name = {row}.task_name",
+    },
+    "tbl_timer_daily_stats": {
+        "archived": "tbl_timer_archived_daily_stats",
+        "keys": ["task_name", "day"],
+        "values": ["{row}.task_name", "substr({row}.start_time, 1, 10)"],
+        "match": (
+            "task_name = {row}.task_name AND start_time >= substr({row}.start_time, 1, 10)"
+            " AND start_time < date(substr({row}.start_time, 1, 10), '+1 day')"
+        ),
+    },
+}
+
+
+def _timer_stats_add(table, spec, row):
+    keys = ", ".join(spec["keys"])
+    values = ", ".join(value.format(row=row) for value in spec["values"])
+    return f"""
+        INSERT INTO {table} ({keys}, count, total, minimum, maximum, total_squares)
+        VALUES ({values}, 1, {row}.duration, {row}.duration, {row}.duration, {row}.duration * {row}.duration)
+        ON CONFLICT ({keys}) DO UPDATE SET
+            count = count + 1,
+            total = total + excluded.total,
+            minimum = MIN(minimum, excluded.minimum),
+            maximum = MAX(maximum, excluded.maximum),
+            total_squares = total_squares + excluded.total_squares;
+    """
+
+
+def _timer_stats_remove(table, spec, row, archived=False):
+    # Sums can be decremented, but a removed minimum or maximum has to be
+    # looked up again from the remaining rows of the group, and with
+    # `archived` from the group's archived aggregates too.
+    key_match = " AND ".join(f"{key} = {value.format(row=row)}" for key, value in zip(spec["keys"], spec["values"]))
+    group = spec["match"].format(row=row)
+    minimum = f"SELECT MIN(duration) FROM tbl_timers WHERE {group}"
+    maximum = f"SELECT MAX(duration) FROM tbl_timers WHERE {group}"
+    if archived:
+        minimum = (
+            f"SELECT MIN(value) FROM (SELECT MIN(duration) AS value FROM tbl_timers WHERE {group}"
+            f" UNION ALL SELECT minimum FROM {spec['archived']} WHERE {key_match})"
+        )
+        maximum = (
+            f"SELECT MAX(value) FROM (SELECT MAX(duration) AS value FROM tbl_timers WHERE {group}"
+            f" UNION ALL SELECT maximum FROM {spec['archived']} WHERE {key_match})"
+        )
+    return f"""
+        UPDATE {table} SET
+            count = count - 1,
+            total = total - {row}.duration,
+            total_squares = total_squares - {row}.duration * {row}.duration,
+            minimum = CASE WHEN {row}.duration > minimum THEN minimum
+                ELSE ({minimum}) END,
+            maximum = CASE WHEN {row}.duration < maximum THEN maximum
+                ELSE ({maximum}) END
+        WHERE {key_match};
+        DELETE FROM {table} WHERE {key_match} AND count <= 0;
+    """
+
+
+def _timer_stats_trigger(name, event, condition, action, row):
+    body = "".join(action(table, spec, row) for table, spec in TIMER_STATS_TABLES.items())
+    return f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON tbl_timers WHEN {condition} BEGIN {body} END"
+
+
+def timer_stats_merge_statement(table, spec, schema="main"):
+    # Adds (keys..., count, total, minimum, maximum, total_squares) rows
+    # into a stats table, combining with any existing row for the key
+    keys = ", ".join(spec["keys"])
+    placeholders = ", ".join("?" * (len(spec["keys"]) + 5))
+    return f"""
+        INSERT INTO {schema}.{table} ({keys}, count, total, minimum, maximum, total_squares)
+        VALUES ({placeholders})
+        ON CONFLICT ({keys}) DO UPDATE SET
+            count = count + excluded.count,
+            total = total + excluded.total,
+            minimum = MIN(minimum, excluded.minimum),
+            maximum = MAX(maximum, excluded.maximum),
+            total_squares = total_squares + excluded.total_squares
+    """
+
+
+def rebuild_timer_stats_statements(schema="main", archived=False):
+    # With `archived`, the archived stats tables are added back in, since
+    # those timers are no longer in tbl_timers to be counted
+    statements = []
+    for table, spec in TIMER_STATS_TABLES.items():
+        keys = ", ".join(spec["keys"])
+        values = ", ".join(value.format(row="tbl_timers") for value in spec["values"])
+        statements.append(f"DELETE FROM {schema}.{table}")
+        if not archived:
+            statements.append(f"""
+                INSERT INTO {schema}.{table} ({keys}, count, total, minimum, maximum, total_squares)
+                SELECT {values}, COUNT(*), SUM(duration), MIN(duration), MAX(duration), SUM(duration * duration)
+                FROM tbl_timers WHERE duration IS NOT NULL
+                GROUP BY {values}
+            """)
+            continue
+        named = ", ".join(f"{value.format(row='tbl_timers')} AS {key}" for key, value in zip(spec["keys"], spec["values"]))
+        statements.append(f"""
+            INSERT INTO {schema}.{table} ({keys}, count, total, minimum, maximum, total_squares)
+            SELECT {keys}, SUM(count), SUM(total), MIN(minimum), MAX(maximum), SUM(total_squares)
+            FROM (
+                SELECT {named}, COUNT(*) AS count, SUM(duration) AS total, MIN(duration) AS minimum,
+                       MAX(duration) AS maximum, SUM(duration * duration) AS total_squares
+                FROM tbl_timers WHERE duration IS NOT NULL
+                GROUP BY {values}
+                UNION ALL
+                SELECT {keys}, count, total, minimum, maximum, total_squares FROM main.{spec["archived"]}
+            )
+            GROUP BY {keys}
+        """)
+    return statements
+
+
+def _note_body(note_id):
+    # A note's inflated body, NULL for notes kept inline
+    return f"(SELECT inflate(body) FROM tbl_note_bodies WHERE note_id = {note_id})"
+
+
+# Schema migrations, applied in order. PRAGMA user_version records how many
+# have run, so each one executes exactly once per database. Never edit a
+# migration that has shipped; append a new one instead.
+MIGRATIONS = [
+    # 1: base tables
+    [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            content TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tbl_timers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_name TEXT NOT NULL,
+            start_time TIMESTAMP,
+            end_time TIMESTAMP,
+            duration INTEGER
+        )
+        """,
+    ],
+    # 2: full-text index over notes. It is an external content table, so it
+    # stores only the index and reads text from tbl_notes. The rebuild
+    # backfills notes written before the index existed.
+    [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS tbl_notes_fts USING fts5(
+            title,
+            content,
+            content='tbl_notes',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tbl_notes_fts_insert AFTER INSERT ON tbl_notes BEGIN
+            INSERT INTO tbl_notes_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tbl_notes_fts_delete AFTER DELETE ON tbl_notes BEGIN
+            INSERT INTO tbl_notes_fts (tbl_notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tbl_notes_fts_update AFTER UPDATE OF title, content ON tbl_notes BEGIN
+            INSERT INTO tbl_notes_fts (tbl_notes_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+            INSERT INTO tbl_notes_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+        END
+        """,
+        "INSERT INTO tbl_notes_fts (tbl_notes_fts) VALUES ('rebuild')",
+    ],
+    # 3: secondary indexes for the timer analytics and recent notes queries
+    [
+        # Covers SUM(duration) ... WHERE task_name = ? without touching the table
+        "CREATE INDEX IF NOT EXISTS idx_timers_task_name ON tbl_timers (task_name, duration)",
+        "CREATE INDEX IF NOT EXISTS idx_timers_start_time ON tbl_timers (start_time)",
+        # Running timers are a tiny fraction of the table
+        "CREATE INDEX IF NOT EXISTS idx_timers_active ON tbl_timers (start_time) WHERE end_time IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_notes_updated_at ON tbl_notes (updated_at)",
+    ],
+    # 4: incrementally maintained timer aggregates
+    [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_timer_task_stats (
+            task_name TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            minimum INTEGER,
+            maximum INTEGER,
+            total_squares INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tbl_timer_daily_stats (
+            task_name TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            minimum INTEGER,
+            maximum INTEGER,
+            total_squares INTEGER NOT NULL,
+            PRIMARY KEY (task_name, day)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_timer_daily_stats_day ON tbl_timer_daily_stats (day)",
+        # Lets the triggers find a day's remaining min/max without a scan
+        "CREATE INDEX IF NOT EXISTS idx_timers_task_start ON tbl_timers (task_name, start_time)",
+        _timer_stats_trigger("tbl_timers_stats_insert", "INSERT", "new.duration IS NOT NULL", _timer_stats_add, "new"),
+        _timer_stats_trigger("tbl_timers_stats_delete", "DELETE", "old.duration IS NOT NULL", _timer_stats_remove, "old"),
+        _timer_stats_trigger(
+            "tbl_timers_stats_update_old", "UPDATE OF task_name, start_time, duration",
+            "old.duration IS NOT NULL", _timer_stats_remove, "old",
+        ),
+        _timer_stats_trigger(
+            "tbl_timers_stats_update_new", "UPDATE OF task_name, start_time, duration",
+            "new.duration IS NOT NULL", _timer_stats_add, "new",
+        ),
+        *rebuild_timer_stats_statements(),
+    ],
+    # 5: per-table change counters for cheap ETag / Last-Modified headers
+    [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            modified_at TIMESTAMP NOT NULL
+        )
+        """,
+        "INSERT OR IGNORE INTO tbl_versions (name, version, modified_at) VALUES ('tbl_notes', 0, datetime('now'))",
+        "INSERT OR IGNORE INTO tbl_versions (name, version, modified_at) VALUES ('tbl_timers', 0, datetime('now'))",
+        *(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table} BEGIN
+                UPDATE tbl_versions SET version = version + 1, modified_at = datetime('now') WHERE name = '{table}';
+            END
+            """
+            for table in ("tbl_notes", "tbl_timers")
+            for event in ("INSERT", "UPDATE", "DELETE")
+        ),
+    ],
+    # 6: change log for delta sync. Each entity keeps only its latest change:
+    # INSERT OR REPLACE drops the old entry and appends a new one with a
+    # higher seq, so the log grows with the number of ids rather than the
+    # number of writes. Delete entries stay behind as tombstones.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (entity, entity_id)
+        )
+        """,
+        "INSERT OR IGNORE INTO tbl_changes (entity, entity_id, op) SELECT 'note', id, 'insert' FROM tbl_notes ORDER BY id",
+        "INSERT OR IGNORE INTO tbl_changes (entity, entity_id, op) SELECT 'timer', id, 'insert' FROM tbl_timers ORDER BY id",
+        *(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_changes_{event.lower()} AFTER {event} ON {table} BEGIN
+                INSERT OR REPLACE INTO tbl_changes (entity, entity_id, op)
+                VALUES ('{entity}', {"old" if event == "DELETE" else "new"}.id, '{event.lower()}');
+            END
+            """
+            for table, entity in (("tbl_notes", "note"), ("tbl_timers", "timer"))
+            for event in ("INSERT", "UPDATE", "DELETE")
+        ),
+    ],
+    # 7: covers GET /timers/stats/, which reads task_name and duration for
+    # every timer in a start_time range, without a table lookup per row
+    [
+        "CREATE INDEX IF NOT EXISTS idx_timers_start_task_duration ON tbl_timers (start_time, task_name, duration)",
+    ],
+    # 8: cold timer archive. Each row is one compressed part file holding
+    # timers of a single month. The archived stats tables keep the moved
+    # timers' share of the aggregates, which the remove triggers now also
+    # consult when a group's minimum or maximum has to be found again.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_timer_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            month TEXT NOT NULL,
+            file TEXT NOT NULL UNIQUE,
+            first_start TIMESTAMP NOT NULL,
+            last_start TIMESTAMP NOT NULL,
+            row_count INTEGER NOT NULL,
+            bytes INTEGER NOT NULL,
+            archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_timer_archive_first_start ON tbl_timer_archive (first_start)",
+        """
+        CREATE TABLE IF NOT EXISTS tbl_timer_archived_task_stats (
+            task_name TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            minimum INTEGER,
+            maximum INTEGER,
+            total_squares INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS tbl_timer_archived_daily_stats (
+            task_name TEXT NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            minimum INTEGER,
+            maximum INTEGER,
+            total_squares INTEGER NOT NULL,
+            PRIMARY KEY (task_name, day)
+        )
+        """,
+        "DROP TRIGGER IF EXISTS tbl_timers_stats_delete",
+        "DROP TRIGGER IF EXISTS tbl_timers_stats_update_old",
+        _timer_stats_trigger(
+            "tbl_timers_stats_delete", "DELETE", "old.duration IS NOT NULL",
+            functools.partial(_timer_stats_remove, archived=True), "old",
+        ),
+        _timer_stats_trigger(
+            "tbl_timers_stats_update_old", "UPDATE OF task_name, start_time, duration",
+            "old.duration IS NOT NULL", functools.partial(_timer_stats_remove, archived=True), "old",
+        ),
+    ],
+    # 9: long note bodies move out of tbl_notes into tbl_note_bodies,
+    # compressed. v_notes joins them back and is where notes are read in full
+    # and written: its triggers split each body by length, deleting a note
+    # before its body and updating a kept body in place. The full-text index
+    # is rebuilt to read its text from v_notes, since tbl_notes no longer
+    # holds all of it. Triggers on tbl_notes and tbl_note_bodies themselves
+    # keep it in step, so writes straight to the tables are indexed too. They
+    # come after the bodies move, which the rebuild covers. A note is
+    # indexed with its inline content, or else its inflated body; each
+    # trigger takes out the text the note was indexed with and puts in its
+    # text after the change.
+    [
+        "CREATE TABLE IF NOT EXISTS tbl_note_bodies (note_id INTEGER PRIMARY KEY, body BLOB NOT NULL)",
+        """
+        CREATE VIEW IF NOT EXISTS v_notes AS
+        SELECT n.id, n.title, COALESCE(n.content, inflate(b.body)) AS content, n.created_at, n.updated_at
+        FROM tbl_notes n
+        LEFT JOIN tbl_note_bodies b ON b.note_id = n.id
+        """,
+        "DROP TRIGGER IF EXISTS tbl_notes_fts_insert",
+        "DROP TRIGGER IF EXISTS tbl_notes_fts_delete",
+        "DROP TRIGGER IF EXISTS tbl_notes_fts_update",
+        "DROP TABLE IF EXISTS tbl_notes_fts",
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS tbl_notes_fts USING fts5(
+            title,
+            content,
+            content='v_notes',
+            content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        f"""
+        INSERT INTO tbl_note_bodies (note_id, body)
+        SELECT id, deflate(content) FROM tbl_notes WHERE length(content) > {NOTE_INLINE_LIMIT}
+        """,
+        "UPDATE tbl_notes SET content = NULL WHERE id IN (SELECT note_id FROM tbl_note_bodies)",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS v_notes_insert INSTEAD OF INSERT ON v_notes BEGIN
+            INSERT INTO tbl_notes (id, title, content, created_at, updated_at)
+            VALUES (
+                new.id, new.title,
+                CASE WHEN length(new.content) > {NOTE_INLINE_LIMIT} THEN NULL ELSE new.content END,
+                COALESCE(new.created_at, CURRENT_TIMESTAMP), COALESCE(new.updated_at, CURRENT_TIMESTAMP)
+            );
+            INSERT INTO tbl_note_bodies (note_id, body)
+            SELECT last_insert_rowid(), deflate(new.content) WHERE length(new.content) > {NOTE_INLINE_LIMIT};
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS v_notes_update INSTEAD OF UPDATE ON v_notes BEGIN
+            UPDATE tbl_notes SET
+                title = new.title,
+                content = CASE WHEN length(new.content) > {NOTE_INLINE_LIMIT} THEN NULL ELSE new.content END,
+                created_at = new.created_at,
+                updated_at = new.updated_at
+            WHERE id = old.id;
+            DELETE FROM tbl_note_bodies WHERE note_id = old.id AND NOT length(new.content) > {NOTE_INLINE_LIMIT};
+            INSERT INTO tbl_note_bodies (note_id, body)
+            SELECT old.id, deflate(new.content) WHERE length(new.content) > {NOTE_INLINE_LIMIT}
+            ON CONFLICT (note_id) DO UPDATE SET body = excluded.body;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS v_notes_delete INSTEAD OF DELETE ON v_notes BEGIN
+            DELETE FROM tbl_notes WHERE id = old.id;
+            DELETE FROM tbl_note_bodies WHERE note_id = old.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS tbl_notes_fts_insert AFTER INSERT ON tbl_notes BEGIN
+            INSERT INTO tbl_notes_fts (rowid, title, content)
+            VALUES (new.id, new.title, COALESCE(new.content, {_note_body("new.id")}));
+        END
+        """,
+        # A long body that stays put leaves content NULL on both sides, so
+        # only a new title reindexes the note here
+        f"""
+        CREATE TRIGGER IF NOT EXISTS tbl_notes_fts_update AFTER UPDATE OF title, content ON tbl_notes
+        WHEN old.title IS NOT new.title OR old.content IS NOT new.content BEGIN
+            INSERT INTO tbl_notes_fts (tbl_notes_fts, rowid, title, content)
+            VALUES ('delete', old.id, old.title, COALESCE(old.content, {_note_body("old.id")}));
+            INSERT INTO tbl_notes_fts (rowid, title, content)
+            VALUES (new.id, new.title, COALESCE(new.content, {_note_body("new.id")}));
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS tbl_notes_fts_delete AFTER DELETE ON tbl_notes BEGIN
+            INSERT INTO tbl_notes_fts (tbl_notes_fts, rowid, title, content)
+            VALUES ('delete', old.id, old.title, COALESCE(old.content, {_note_body("old.id")}));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tbl_note_bodies_fts_insert AFTER INSERT ON tbl_note_bodies BEGIN
+            INSERT INTO tbl_notes_fts (tbl_notes_fts, rowid, title, content)
+            SELECT 'delete', id, title, content FROM tbl_notes WHERE id = new.note_id;
+            INSERT INTO tbl_notes_fts (rowid, title, content)
+            SELECT id, title, COALESCE(content, inflate(new.body)) FROM tbl_notes WHERE id = new.note_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tbl_note_bodies_fts_update AFTER UPDATE OF body ON tbl_note_bodies BEGIN
+            INSERT INTO tbl_notes_fts (tbl_notes_fts, rowid, title, content)
+            SELECT 'delete', id, title, COALESCE(content, inflate(old.body)) FROM tbl_notes WHERE id = old.note_id;
+            INSERT INTO tbl_notes_fts (rowid, title, content)
+            SELECT id, title, COALESCE(content, inflate(new.body)) FROM tbl_notes WHERE id = new.note_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS tbl_note_bodies_fts_delete AFTER DELETE ON tbl_note_bodies BEGIN
+            INSERT INTO tbl_notes_fts (tbl_notes_fts, rowid, title, content)
+            SELECT 'delete', id, title, COALESCE(content, inflate(old.body)) FROM tbl_notes WHERE id = old.note_id;
+            INSERT INTO tbl_notes_fts (rowid, title, content)
+            SELECT id, title, content FROM tbl_notes WHERE id = old.note_id;
+        END
+        """,
+        "INSERT INTO tbl_notes_fts (tbl_notes_fts) VALUES ('rebuild')",
+    ],
+    # 10: idempotency keys of bulk-created rows, so a bulk create resent
+    # after a lost response returns the rows it made the first time
+    [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_idempotency_keys (
+            tbl TEXT NOT NULL,
+            key TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (tbl, key)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON tbl_idempotency_keys (created_at)",
+    ],
+    # 11: bulk mutation jobs, kept in the database so every worker reports
+    # and cancels them alike. The worker running a job updates its row with
+    # each chunk it writes.
+    [
+        """
+        CREATE TABLE IF NOT EXISTS tbl_jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            state TEXT NOT NULL,
+            candidates INTEGER,
+            processed INTEGER NOT NULL DEFAULT 0,
+            changed INTEGER NOT NULL DEFAULT 0,
+            chunks INTEGER NOT NULL DEFAULT 0,
+            started_at TEXT NOT NULL,
+            seconds REAL,
+            finished_at TEXT,
+            error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_finished_at ON tbl_jobs (finished_at)",
+    ],
+]
+
+
+def open_connection(path=DB_PATH):
+    # check_same_thread is off because FastAPI may run the dependency and the
+    # handler on different threadpool workers; the pool hands each connection
+    # to one request at a time.
+    db = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    for name, value in PRAGMAS.items():
+        db.execute(f"PRAGMA {name}={value}")
+    return register_functions(db)
+
+
+def register_functions(db):
+    # SQL functions the schema relies on: v_notes inflates long note bodies
+    # and its triggers deflate them, so every connection that touches notes
+    # needs these
+    db.create_function("deflate", 1, _deflate, deterministic=True)
+    db.create_function("inflate", 1, _inflate, deterministic=True)
+    return db
+
+
+@contextmanager
+def file_lock(path):
+    # Exclusive across processes; blocks until the lock is free
+    with open(path, "a+b") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after about ten seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db):
+    register_functions(db)
+    version = schema_version(db)
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                db.execute(statement)
+            db.execute(f"PRAGMA user_version = {number}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return schema_version(db)
+
+
+class ConnectionPool:
+    def __init__(self, path=DB_PATH, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+    def acquire(self):
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return open_connection(self.path)
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise RuntimeError("Timed out waiting for a database connection")
+
+    def release(self, db):
+        # A handler that raised half-way may leave a transaction open
+        if db.in_transaction:
+            db.rollback()
+        if self._closed:
+            self._discard(db)
+            return
+        self._idle.put_nowait(db)
+
+    def _discard(self, db):
+        db.close()
+        with self._lock:
+            self._created -= 1
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(db)
+
+
+# Counters for the writer thread's commit groups
+class WriteStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.groups = 0
+        self.writes = 0
+        self.failed_writes = 0
+        self.failed_groups = 0
+        self.max_group_size = 0
+        self.commit_seconds = 0.0
+        self.max_commit_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, size, failed, committed, commit_seconds, wait_seconds):
+        # wait_seconds is the longest any write in the group spent queued
+        with self._lock:
+            self.groups += 1
+            self.writes += size
+            self.failed_writes += failed
+            self.failed_groups += not committed
+            self.max_group_size = max(self.max_group_size, size)
+            self.commit_seconds += commit_seconds
+            self.max_commit_seconds = max(self.max_commit_seconds, commit_seconds)
+            self.wait_seconds += wait_seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+
+    def snapshot(self):
+        with self._lock:
+            groups = self.groups
+            return {
+                "groups": groups,
+                "writes": self.writes,
+                "failed_writes": self.failed_writes,
+                "failed_groups": self.failed_groups,
+                "mean_group_size": self.writes / groups if groups else None,
+                "max_group_size": self.max_group_size,
+                "mean_commit_ms": self.commit_seconds * 1000 / groups if groups else None,
+                "max_commit_ms": self.max_commit_seconds * 1000,
+                "mean_queue_wait_ms": self.wait_seconds * 1000 / groups if groups else None,
+                "max_queue_wait_ms": self.max_wait_seconds * 1000,
+            }
+
+
+# Async access to SQLite that never blocks the event loop. Reads run
+# concurrently on a dedicated thread pool, each on a pooled connection.
+# Writes are queued to a single writer thread. It takes the first queued
+# write and, if the previous group had more than one write, waits up to
+# write_batch_delay for others to join until the group reaches
+# write_batch_size. The group is committed as one transaction. Every
+# write runs in its own savepoint, so one failing write does not undo the
+# others in its group. Write functions must not commit themselves.
+class Database:
+
+    def __init__(
+        self,
+        path=DB_PATH,
+        read_workers=READ_WORKERS,
+        write_batch_size=WRITE_BATCH_SIZE,
+        write_batch_delay=WRITE_BATCH_DELAY,
+    ):
+        self.path = path
+        self.pool = ConnectionPool(path, read_workers)
+        self.write_batch_size = write_batch_size
+        self.write_batch_delay = write_batch_delay
+        self.write_stats = WriteStats()
+        # The last error that failed a whole write group outside its writes
+        self.last_write_error = None
+        self._readers = None
+        self._writes = queue.Queue()
+        self._writer = None
+        # Called on the event loop after every committed write group
+        self.commit_listeners = []
+        # Called on the database thread with (statement, seconds, rows) after
+        # each statement run through fetchone/fetchall/execute, and
+        # with (function name, seconds, 0) for other write functions
+        self.statement_observers = []
+        # Called with the seconds a reader waited for a pooled connection
+        self.acquire_observers = []
+
+    def start(self):
+        self._readers = ThreadPoolExecutor(max_workers=self.pool.size, thread_name_prefix="db-read")
+        self._writer = threading.Thread(target=self._write_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    def close(self):
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._readers is not None:
+            self._readers.shutdown()
+            self._readers = None
+        self.pool.close()
+
+    def _read(self, fn, args):
+        started = time.perf_counter()
+        db = self.pool.acquire()
+        for observer in self.acquire_observers:
+            observer(time.perf_counter() - started)
+        try:
+            return fn(db, *args)
+        finally:
+            self.pool.release(db)
+
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._read, fn, args)
+
+    async def write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._writes.put((fn, args, loop, future, time.monotonic()))
+        return await future
+
+    def _observe(self, statement, seconds, rows):
+        for observer in self.statement_observers:
+            observer(statement, seconds, rows)
+
+    def _run(self, db, query, params, fetch):
+        started = time.perf_counter()
+        result, rows = fetch(db.execute(query, params))
+        self._observe(query, time.perf_counter() - started, rows)
+        return result
+
+    async def fetchone(self, query, params=()):
+        return await self.read(self._run, query, params, _fetch_one)
+
+    async def fetchall(self, query, params=()):
+        return await self.read(self._run, query, params, _fetch_all)
+
+    async def execute(self, query, params=()):
+        # The returned cursor still carries lastrowid and rowcount
+        return await self.write(self._run, query, params, _fetch_cursor)
+
+    async def prewarm(self, statements, read_bytes=PREWARM_BYTES):
+        # Reads the start of the database file so a cold worker does not
+        # fault its pages in one query at a time, then opens every pooled
+        # connection and steps each (query, params) once on it. That leaves
+        # the statements in the connection's statement cache and the pages
+        # they touch in its page cache.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._readers, _read_file, self.path, read_bytes)
+        connections = []
+        try:
+            for _ in range(self.pool.size):
+                connections.append(await loop.run_in_executor(self._readers, self.pool.acquire))
+            await asyncio.gather(
+                *(loop.run_in_executor(self._readers, _step_all, db, statements) for db in connections)
+            )
+        finally:
+            for db in connections:
+                self.pool.release(db)
+
+    def stats(self):
+        return {
+            "write_batch_size": self.write_batch_size,
+            "write_batch_delay_ms": self.write_batch_delay * 1000,
+            "synchronous": WRITE_SYNCHRONOUS,
+            "last_write_error": self.last_write_error,
+            **self.write_stats.snapshot(),
+        }
+
+    def _open_writer(self):
+        db = open_connection(self.path)
+        db.execute(f"PRAGMA synchronous={WRITE_SYNCHRONOUS}")
+        return db
+
+    def _write_loop(self):
+        db = None
+        running = True
+        last_size = 0
+        while running:
+            batch = [self._writes.get()]
+            # Waiting only pays off when writes arrive concurrently, so a
+            # lone writer is not held back
+            deadline = time.monotonic() + (self.write_batch_delay if last_size > 1 else 0)
+            while batch[-1] is not None and len(batch) < self.write_batch_size:
+                try:
+                    batch.append(self._writes.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                running = False
+            if batch:
+                try:
+                    if db is None:
+                        db = self._open_writer()
+                    self._commit_batch(db, batch)
+                except Exception as e:
+                    # Failing to open the connection, or anything else
+                    # _commit_batch does not turn into a result, fails the
+                    # group rather than the thread, so later writes still
+                    # get an answer. The connection is opened afresh for
+                    # the next group.
+                    self.last_write_error = repr(e)
+                    for entry in batch:
+                        _resolve_soon(entry[2], entry[3], None, e)
+                    if db is not None:
+                        db.close()
+                        db = None
+            last_size = len(batch)
+        if db is not None:
+            db.close()
+
+    def _commit_batch(self, db, batch):
+        started = time.monotonic()
+        results = []
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for fn, args, loop, future, queued_at in batch:
+                db.execute("SAVEPOINT write")
+                try:
+                    write_started = time.perf_counter()
+                    results.append((fn(db, *args), None))
+                    if fn != self._run:
+                        # _run observes its own statement
+                        self._observe(f"{fn.__name__}()", time.perf_counter() - write_started, 0)
+                    db.execute("RELEASE write")
+                except Exception as e:
+                    db.execute("ROLLBACK TO write")
+                    db.execute("RELEASE write")
+                    results.append((None, e))
+            db.commit()
+            committed = True
+        except Exception as e:
+            if db.in_transaction:
+                db.rollback()
+            results = [(None, e)] * len(batch)
+            committed = False
+        finished = time.monotonic()
+        # Nothing is acknowledged until the whole group has committed
+        for (fn, args, loop, future, queued_at), (value, error) in zip(batch, results):
+            _resolve_soon(loop, future, value, error)
+        self.write_stats.record(
+            len(batch),
+            sum(error is not None for value, error in results),
+            committed,
+            finished - started,
+            started - min(entry[4] for entry in batch),
+        )
+        if committed:
+            for loop in {entry[2] for entry in batch}:
+                for listener in self.commit_listeners:
+                    loop.call_soon_threadsafe(listener)
+
+
+def _read_file(path, limit, chunk=1024 * 1024):
+    with open(path, "rb") as file:
+        while limit > 0 and file.read(min(chunk, limit)):
+            limit -= chunk
+
+
+def _step_all(db, statements):
+    for query, params in statements:
+        db.execute(query, params).fetchone()
+
+
+def _deflate(text):
+    return None if text is None else zlib.compress(text.encode(), NOTE_COMPRESSION_LEVEL)
+
+
+def _inflate(body):
+    return None if body is None else zlib.decompress(body).decode()
+
+
+def _fetch_one(cursor):
+    row = cursor.fetchone()
+    return row, int(row is not None)
+
+
+def _fetch_all(cursor):
+    rows = cursor.fetchall()
+    return rows, len(rows)
+
+
+def _fetch_cursor(cursor):
+    # rowcount is -1 for statements that change no rows
+    return cursor, max(cursor.rowcount, 0)
+
+
+def _resolve_soon(loop, future, value, error):
+    try:
+        loop.call_soon_threadsafe(_resolve, future, value, error)
+    except RuntimeError:
+        # The loop has closed, so nobody is waiting for the result
+        pass
+
+
+def _resolve(future, value, error):
+    # Done already if the writer failed a group it had partly answered
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(value)
@@ -0,0 +1,35 @@
+import asyncio
+import os
+
+# Longest an event stream waits before looking at the change log again.
+# Commits made by this process wake the streams at once; the timeout only
+# matters for writes from other worker processes.
+EVENTS_POLL_INTERVAL = float(os.environ.get("MEMOTIME_EVENTS_POLL_INTERVAL", 2.0))
+# A comment line is sent at least this often so proxies keep idle streams open
+EVENTS_HEARTBEAT = float(os.environ.get("MEMOTIME_EVENTS_HEARTBEAT", 15.0))
+# Streams end after this long and the client reconnects with Last-Event-ID.
+# The server cannot tell an open stream that it is shutting down, so this
+# bounds how long a graceful shutdown waits on connected clients.
+EVENTS_MAX_AGE = float(os.environ.get("MEMOTIME_EVENTS_MAX_AGE", 30.0))
+
+
+# Wakes event streams when the database commits. Each notify() replaces the
+# current event, so a stream grabs it before reading the change log and a
+# commit that lands while it reads still wakes its next wait.
+class ChangeFeed:
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def notify(self):
+        # Runs on the event loop, scheduled by the database writer thread
+        self._event.set()
+        self._event = asyncio.Event()
+
+    def current(self):
+        return self._event
+
+    async def wait(self, event, timeout=EVENTS_POLL_INTERVAL):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
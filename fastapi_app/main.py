@@ -1,47 +1,186 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from fastapi import Body, Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+import asyncio
+import base64
+import binascii
+import csv
+import hashlib
+import io
+import json
+import os
 import sqlite3
-from datetime import datetime
-from typing import List
+import time
+from datetime import date, datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import List, Literal, Optional, Union
 
-app = FastAPI()
+from archive import TimerArchive
+from cache import ResponseCache
+from database import DB_PATH, Database, file_lock, migrate
+from events import EVENTS_HEARTBEAT, EVENTS_MAX_AGE, EVENTS_POLL_INTERVAL, ChangeFeed
+from metrics import PROFILE_ENABLED, ROW_BUCKETS, Metrics, RequestMetrics, SamplingProfiler, statement_label
+from mutations import CHUNK_IDS, BulkMutation, MutationJobs
+
+# Worker processes opt in to warming their connections before serving
+DB_PREWARM = os.environ.get("MEMOTIME_DB_PREWARM", "") not in ("", "0")
 
 # SQLite Database Initialization
 def initialize_database():
-    db = sqlite3.connect("memotime.db")
-    cursor = db.cursor()
-
-    # Create tables
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS tbl_notes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT NOT NULL,
-        content TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    """)
-
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS tbl_timers (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        task_name TEXT NOT NULL,
-        start_time TIMESTAMP,
-        end_time TIMESTAMP,
-        duration INTEGER
-    )
-    """)
+    # Every worker runs this as it starts. The first to take the lock
+    # migrates; the others wait for it and then find nothing left to do.
+    with file_lock(DB_PATH + ".lock"):
+        db = sqlite3.connect(DB_PATH)
+        migrate(db)
+        db.close()
+
+database = Database(DB_PATH)
+cache = ResponseCache()
+changes = ChangeFeed()
+database.commit_listeners.append(changes.notify)
+metrics = Metrics()
+profiler = SamplingProfiler()
+archive = TimerArchive()
+jobs = MutationJobs()
+
+def observe_statement(statement, seconds, rows):
+    labels = (statement_label(statement),)
+    metrics.observe("memotime_sql_duration_seconds", "Time SQLite spent on a statement", ("statement",), labels, seconds)
+    metrics.observe("memotime_sql_rows", "Rows returned or changed by a statement", ("statement",), labels, rows, ROW_BUCKETS)
+
+def observe_acquire(seconds):
+    metrics.observe("memotime_db_acquire_seconds", "Time a reader waited for a pooled connection", (), (), seconds)
 
-    db.commit()
-    cursor.close()
-    db.close()
+database.statement_observers.append(observe_statement)
+database.acquire_observers.append(observe_acquire)
 
-# Initialize the database when the app starts
-initialize_database()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    initialize_database()
+    database.start()
+    if DB_PREWARM:
+        await database.prewarm(prewarm_statements())
+    if PROFILE_ENABLED:
+        profiler.enable()
+    archiver = asyncio.create_task(archive.run(database)) if archive.retention_months else None
+    yield
+    await jobs.close(database)
+    if archiver is not None:
+        archiver.cancel()
+        try:
+            await archiver
+        except asyncio.CancelledError:
+            pass
+    profiler.disable()
+    database.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# Responses at least this large are gzipped for clients that accept it.
+# Level 5 keeps most of the size win at a fraction of level 9's CPU cost.
+GZIP_MINIMUM_SIZE = int(os.environ.get("MEMOTIME_GZIP_MINIMUM_SIZE", 1024))
+GZIP_LEVEL = int(os.environ.get("MEMOTIME_GZIP_LEVEL", 5))
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=GZIP_LEVEL)
+# Outermost, so response sizes are what went over the wire
+app.add_middleware(RequestMetrics, metrics=metrics, profiler=profiler)
 
 # Database Connection
-def get_db_connection():
-    return sqlite3.connect("memotime.db")
+def get_database():
+    return database
+
+# Cache keys for the hot read endpoints
+NOTE_COUNT_KEY = "notes:count"
+RECENT_NOTES_KEY = "notes:recent"
+AVERAGE_DURATION_KEY = "timers:average-duration"
+
+def note_key(note_id):
+    return f"notes:{note_id}"
+
+@app.get("/cache/stats/")
+async def get_cache_stats():
+    return cache.stats()
+
+@app.get("/database/stats/")
+async def get_database_stats():
+    # Write grouping: sizes, commit times and how long writes queued
+    return database.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text format. The cache and write-group counters are
+    # exported as gauges read at scrape time.
+    gauges = [
+        (f"memotime_{prefix}_{key}", f"{source} {key.replace('_', ' ')}", value)
+        for prefix, source, stats in (("cache", "Response cache", cache.stats()), ("db_write", "Write groups", database.stats()))
+        for key, value in stats.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    ]
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+@app.post("/metrics/profiler/")
+async def set_profiler(enabled: bool, slow_ms: Optional[float] = Query(None, gt=0)):
+    # Slow requests get their sampled stacks written as .folded files
+    if enabled:
+        profiler.enable(slow_ms / 1000 if slow_ms else None)
+    else:
+        profiler.disable()
+    return profiler.status()
+
+# Conditional Requests
+
+def http_date(timestamp):
+    # SQLite's datetime('now') values are UTC without a zone suffix
+    if not timestamp:
+        return None
+    value = datetime.fromisoformat(str(timestamp)[:19])
+    return format_datetime(value.replace(tzinfo=timezone.utc), usegmt=True)
+
+def etag_matches(etag, if_none_match):
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+def not_modified(request, response, etag, last_modified=None):
+    # Sets the validators on the response and returns a 304 response if the
+    # client's copy is still current, otherwise None. If-None-Match wins over
+    # If-Modified-Since when both are sent.
+    headers = {"ETag": etag}
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    response.headers.update(headers)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        fresh = etag_matches(etag, if_none_match)
+    elif last_modified and request.headers.get("if-modified-since"):
+        try:
+            fresh = parsedate_to_datetime(last_modified) <= parsedate_to_datetime(request.headers["if-modified-since"])
+        except (TypeError, ValueError):
+            fresh = False
+    else:
+        fresh = False
+    return Response(status_code=304, headers=headers) if fresh else None
+
+TABLE_VERSION_QUERY = "SELECT version, modified_at FROM tbl_versions WHERE name = ?"
+
+async def collection_not_modified(request, response, db, table):
+    # Collection validators come from the table's change counter, which the
+    # version triggers bump on every write, so checking costs one lookup.
+    version, modified_at = await db.fetchone(TABLE_VERSION_QUERY, (table,))
+    query = hashlib.blake2b(str(request.url.query).encode(), digest_size=6).hexdigest()
+    return not_modified(request, response, f'W/"{table}-{version}-{query}"', http_date(modified_at))
+
+async def table_version(db, table):
+    # Cached responses are checked against this, so a write in any worker
+    # process makes them stale
+    return (await db.fetchone(TABLE_VERSION_QUERY, (table,)))[0]
+
+def item_not_modified(request, response, item, last_modified=None):
+    body = json.dumps(item, sort_keys=True, default=str).encode()
+    return not_modified(request, response, '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"', last_modified)
 
 # Models for Pydantic
 class Note(BaseModel):
@@ -51,290 +190,1240 @@ class Note(BaseModel):
 class Timer(BaseModel):
     task_name: str
     start_time: datetime
-    end_time: datetime
+    end_time: Optional[datetime] = None  # None while the timer is running
+
+class TimerStart(BaseModel):
+    task_name: str
+    start_time: Optional[datetime] = None  # defaults to now
+
+class TimerStop(BaseModel):
+    end_time: Optional[datetime] = None  # defaults to now
+
+# Bulk updates and deletes pick rows by ids, a filter, or both
+class NoteFilter(BaseModel):
+    ids: Optional[List[int]] = None
+    title: Optional[str] = None  # matched like /notes/search/?title=
+    updated_start: Optional[datetime] = None
+    updated_end: Optional[datetime] = None
+
+class NoteChanges(BaseModel):
+    title: Optional[str] = None
+    content: Optional[str] = None
+
+class NoteBulkUpdate(BaseModel):
+    where: NoteFilter
+    set: NoteChanges
+
+class TimerFilter(BaseModel):
+    ids: Optional[List[int]] = None
+    task_name: Optional[str] = None
+    start: Optional[datetime] = None  # start_time bounds, as in /timers/range/
+    end: Optional[datetime] = None
+
+class TimerChanges(BaseModel):
+    task_name: str
+
+class TimerBulkUpdate(BaseModel):
+    where: TimerFilter
+    set: TimerChanges
+
+# Serialization
+
+# List responses bypass FastAPI's jsonable_encoder. SQLite only hands back
+# str, int, float and None, so rows are zipped with their column names and
+# written in one pass by the C encoder; `default` covers anything else.
+JSON_ENCODER = json.JSONEncoder(ensure_ascii=False, check_circular=False, separators=(",", ":"), default=str)
+
+def passed_headers(response):
+    # A returned response does not pick up headers set on `response`
+    return {name: value for name, value in response.headers.items() if name != "content-length"}
+
+def observe_serialization(format, started):
+    metrics.observe(
+        "memotime_serialize_seconds", "Time spent encoding a list response", ("format",), (format,),
+        time.perf_counter() - started,
+    )
+
+def rows_response(columns, rows, response, skip=0):
+    # `skip` drops leading columns selected for the query's own use
+    started = time.perf_counter()
+    body = JSON_ENCODER.encode([dict(zip(columns, row[skip:] if skip else row)) for row in rows])
+    observe_serialization("json", started)
+    return Response(body, media_type="application/json", headers=passed_headers(response))
+
+def columns_response(columns, rows, response, skip=0):
+    # One array per column instead of one object per row, so keys are not
+    # repeated: {"id": [1, 2], "title": ["a", "b"], ...}
+    started = time.perf_counter()
+    values = list(zip(*rows))[skip:] if rows else [()] * len(columns)
+    body = JSON_ENCODER.encode(dict(zip(columns, values)))
+    observe_serialization("columns", started)
+    return Response(body, media_type="application/json", headers=passed_headers(response))
+
+def encode_rows(format):
+    return columns_response if format == "columns" else rows_response
+
+# Keyset Pagination
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+NOTE_COLUMNS = ["id", "title", "content", "created_at", "updated_at"]
+TIMER_COLUMNS = ["id", "task_name", "start_time", "end_time", "duration"]
+
+def encode_page_token(order, row):
+    payload = json.dumps([order, row[0], row[1]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_page_token(token, order):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        token_order, key, last_id = json.loads(base64.urlsafe_b64decode(padded))
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid page token")
+    if token_order != order:
+        raise HTTPException(status_code=400, detail="Page token does not match the requested order")
+    return key, last_id
+
+def keyset_query(table, columns, order, after, limit=None, where=None, params=(), key=None):
+    # Pages are ordered by (order, id) so ties on the sort column are stable.
+    # The sort key and id are selected first for building the next token.
+    # `key` is an already decoded (order, id) to resume after. `params` binds
+    # the placeholders in `columns`, then those in `where`.
+    conditions = [where] if where else []
+    params = list(params)
+    if after:
+        key = decode_page_token(after, order)
+    if key is not None:
+        conditions.append(f"({order}, id) > (?, ?)")
+        params.extend(key)
+    query = f"SELECT {order}, id, {', '.join(columns)} FROM {table}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {order}, id"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return query, params
+
+async def fetch_page(db, table, columns, order, after, limit, format, response, where=None, params=(), select=None):
+    query, params = keyset_query(table, select or columns, order, after, limit + 1, where, params)
+    rows = await db.fetchall(query, params)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Page"] = encode_page_token(order, rows[-1])
+    return encode_rows(format)(columns, rows, response, skip=2)
+
+async def keyset_batches(db, table, columns, order, key, limit, where=None, params=()):
+    # Every batch is a read of its own that resumes after the last row sent,
+    # so a slow client holds neither a pooled connection nor a read
+    # transaction between batches
+    while limit is None or limit > 0:
+        size = STREAM_BATCH_SIZE if limit is None else min(STREAM_BATCH_SIZE, limit)
+        query, query_params = keyset_query(table, columns, order, None, size, where, params, key)
+        rows = await db.fetchall(query, query_params)
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        key = rows[-1][0], rows[-1][1]
+        if limit is not None:
+            limit -= len(rows)
+
+async def stream_ndjson(batches, columns, skip=0):
+    encode = JSON_ENCODER.encode
+    async for rows in batches:
+        yield "".join(encode(dict(zip(columns, row[skip:]))) + "\n" for row in rows)
+
+async def stream_csv(batches, columns, skip=0):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    async for rows in batches:
+        writer.writerows(row[skip:] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+STREAM_FORMATS = {
+    "ndjson": (stream_ndjson, "application/x-ndjson"),
+    "csv": (stream_csv, "text/csv"),
+}
+
+def stream_rows(batches, columns, format, response, skip=0):
+    # batches is an async iterator of row lists, usually keyset_batches()
+    stream, media_type = STREAM_FORMATS[format]
+    return StreamingResponse(
+        stream(batches, columns, skip), media_type=media_type, headers=passed_headers(response)
+    )
+
+async def list_rows(db, table, columns, order, after, limit, format, response, where=None, params=(), select=None):
+    # ndjson and csv stream every row after `after`, or the first `limit`;
+    # json and columns return one page. `select` holds the SELECT expressions
+    # for `columns` when they are not plain column names.
+    if format in STREAM_FORMATS:
+        # Decoded here, as a bad token must fail before the response starts
+        key = decode_page_token(after, order) if after else None
+        batches = keyset_batches(db, table, select or columns, order, key, limit, where, params)
+        return stream_rows(batches, columns, format, response, skip=2)
+    return await fetch_page(
+        db, table, columns, order, after, limit or DEFAULT_PAGE_SIZE, format, response, where, params, select
+    )
+
+# Bulk Ingest
+
+BULK_CHUNK_SIZE = 1000
+# How long an item's idempotency_key is remembered. A client that resends
+# a bulk create after a lost response gets the ids made the first time.
+IDEMPOTENCY_KEY_DAYS = 7
+
+IDEMPOTENCY_KEYS_QUERY = "SELECT key, row_id FROM tbl_idempotency_keys WHERE tbl = ? AND key IN (SELECT value FROM json_each(?))"
+
+async def read_bulk_items(request):
+    # Yields (index, parsed item or Exception). NDJSON bodies are parsed line
+    # by line as they arrive; anything else must be one JSON array.
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" in content_type or "jsonl" in content_type:
+        index = 0
+        buffer = b""
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield index, parse_json(line)
+                    index += 1
+        if buffer.strip():
+            yield index, parse_json(buffer)
+        return
+    try:
+        items = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+    for index, item in enumerate(items):
+        yield index, item
+
+def parse_json(line):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+# Errors the database raises for a row itself, which resending will not fix
+ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.DataError)
+
+def last_id(db, table):
+    row = db.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    return row[0] if row else 0
+
+def insert_chunk(db, table, query, rows, keys):
+    # A write function. Returns the id of each row, None for a row the
+    # database refused, the number of rows whose key (None for none) was
+    # already stored and so got the id stored with it instead of being
+    # inserted again, and {position: error} for the refused rows.
+    known = {}
+    if any(key is not None for key in keys):
+        db.execute("DELETE FROM tbl_idempotency_keys WHERE created_at < datetime('now', ?)", (f"-{IDEMPOTENCY_KEY_DAYS} days",))
+        known = dict(db.execute(IDEMPOTENCY_KEYS_QUERY, (table, json.dumps([key for key in keys if key is not None]))))
+    db.execute("SAVEPOINT chunk")
+    try:
+        result = insert_rows(db, table, query, rows, keys, dict(known))
+        db.execute("RELEASE chunk")
+        return result
+    except ROW_ERRORS:
+        db.execute("ROLLBACK TO chunk")
+        db.execute("RELEASE chunk")
+    return insert_rows_singly(db, table, query, rows, keys, known)
+
+def insert_rows(db, table, query, rows, keys, known):
+    # AUTOINCREMENT hands out sqlite_sequence + 1, + 2, ... and the writer
+    # holds the write lock throughout, so the new ids are contiguous
+    next_id = last_id(db, table) + 1
+    ids, new_rows, new_keys, replayed = [], [], [], 0
+    for values, key in zip(rows, keys):
+        if key in known:
+            ids.append(known[key])
+            replayed += 1
+            continue
+        if key is not None:
+            known[key] = next_id
+            new_keys.append((table, key, next_id))
+        ids.append(next_id)
+        new_rows.append(values)
+        next_id += 1
+    db.executemany(query, new_rows)
+    db.executemany("INSERT INTO tbl_idempotency_keys (tbl, key, row_id) VALUES (?, ?, ?)", new_keys)
+    return ids, replayed, {}
+
+def insert_rows_singly(db, table, query, rows, keys, known):
+    # After the database refused a chunk: one savepoint per row, so only
+    # the rows it refuses are left out
+    ids, replayed, failed = [], 0, {}
+    for position, (values, key) in enumerate(zip(rows, keys)):
+        if key in known:
+            ids.append(known[key])
+            replayed += 1
+            continue
+        db.execute("SAVEPOINT item")
+        try:
+            db.execute(query, values)
+        except ROW_ERRORS as e:
+            db.execute("ROLLBACK TO item")
+            db.execute("RELEASE item")
+            ids.append(None)
+            failed[position] = str(e)
+            continue
+        db.execute("RELEASE item")
+        ids.append(last_id(db, table))
+        if key is not None:
+            known[key] = ids[-1]
+            db.execute("INSERT INTO tbl_idempotency_keys (tbl, key, row_id) VALUES (?, ?, ?)", (table, key, ids[-1]))
+    return ids, replayed, failed
+
+async def bulk_insert(db, request, model, table, query, to_row):
+    # Items may carry an idempotency_key next to their fields. `ids` lists
+    # the id of every accepted item in order, replayed ones included.
+    # Chunks are written one by one, so a chunk that fails leaves those
+    # before it in place; its items are reported with "retry": true, as
+    # sending them again may succeed.
+    result = {"created": 0, "replayed": 0, "ids": [], "errors": []}
+    errors, chunk, keys, indexes = result["errors"], [], [], []
+
+    async def write_chunk():
+        try:
+            ids, replayed, failed = await db.write(insert_chunk, table, query, chunk, keys)
+        except Exception as e:
+            errors.extend({"index": index, "detail": repr(e), "retry": True} for index in indexes)
+            return
+        errors.extend({"index": indexes[position], "detail": detail} for position, detail in failed.items())
+        result["ids"].extend(row_id for row_id in ids if row_id is not None)
+        result["replayed"] += replayed
+        result["created"] += len(ids) - replayed - len(failed)
+
+    async for index, item in read_bulk_items(request):
+        try:
+            if isinstance(item, Exception):
+                raise item
+            key = item.pop("idempotency_key", None) if isinstance(item, dict) else None
+            if key is not None and not isinstance(key, str):
+                raise ValueError("idempotency_key must be a string")
+            chunk.append(to_row(model.model_validate(item)))
+            keys.append(key)
+            indexes.append(index)
+        except (ValidationError, ValueError) as e:
+            detail = e.errors(include_url=False, include_context=False) if isinstance(e, ValidationError) else str(e)
+            errors.append({"index": index, "detail": detail})
+            continue
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            await write_chunk()
+            chunk, keys, indexes = [], [], []
+    if chunk:
+        await write_chunk()
+    errors.sort(key=lambda error: error["index"])
+    return result
 
 # Notes Management
 
+# Notes are written through v_notes, whose triggers store long bodies
+# compressed in tbl_note_bodies, and read from it wherever the full content
+# is needed. Listings that leave content out read tbl_notes alone. The
+# full-text index follows the tables under the view.
+INSERT_NOTE_QUERY = "INSERT INTO v_notes (title, content, created_at, updated_at) VALUES (?, ?, datetime('now'), datetime('now'))"
+NOTE_PREVIEW_MAX = 1000
+
+def note_fields(fields, allowed=NOTE_COLUMNS):
+    # ?fields=id,title narrows a listing to those columns, in that order
+    if fields is None:
+        return list(allowed)
+    columns = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip()))
+    if not columns or any(column not in allowed for column in columns):
+        raise HTTPException(status_code=400, detail=f"fields must be a comma-separated subset of: {', '.join(allowed)}")
+    return columns
+
+def note_select(column, preview, alias="", placeholder="?"):
+    # With ?preview=N content is cut to its first N characters. N is bound
+    # through `placeholder`, so every N shares one statement.
+    if column == "content" and preview:
+        return f"substr({alias}content, 1, {placeholder}) AS content"
+    return alias + column
+
+def notes_source(columns):
+    return "v_notes" if "content" in columns else "tbl_notes"
+
+def project_note(note, columns, preview):
+    return {
+        column: note[column][:preview] if column == "content" and preview and note[column] else note[column]
+        for column in columns
+    }
+
 @app.post("/notes/")
-def create_note(note: Note):
-    db = get_db_connection()
-    cursor = db.cursor()
-    query = "INSERT INTO tbl_notes (title, content, created_at, updated_at) VALUES (?, ?, datetime('now'), datetime('now'))"
-    cursor.execute(query, (note.title, note.content))
-    db.commit()
-    cursor.close()
-    db.close()
+async def create_note(note: Note, db: Database = Depends(get_database)):
+    await db.execute(INSERT_NOTE_QUERY, (note.title, note.content))
+    cache.invalidate(NOTE_COUNT_KEY, RECENT_NOTES_KEY)
     return {"message": "Note created successfully"}
 
 @app.get("/notes/")
-def get_all_notes():
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM tbl_notes")
-    notes = [dict(id=row[0], title=row[1], content=row[2], created_at=row[3], updated_at=row[4]) for row in cursor.fetchall()]
-    cursor.close()
-    db.close()
-    return notes
+async def get_all_notes(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    order: Literal["id", "updated_at"] = "id",
+    format: Literal["json", "columns", "ndjson", "csv"] = "json",
+    fields: Optional[str] = None,
+    preview: Optional[int] = Query(None, ge=1, le=NOTE_PREVIEW_MAX),
+    db: Database = Depends(get_database),
+):
+    columns = note_fields(fields)
+    select = [note_select(column, preview) for column in columns]
+    params = [preview] if preview and "content" in columns else []
+    return (
+        await collection_not_modified(request, response, db, "tbl_notes")
+        or await list_rows(
+            db, notes_source(columns), columns, order, after, limit, format, response, params=params, select=select
+        )
+    )
 
 @app.get("/notes/{note_id}")
-def get_note_by_id(note_id: int):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM tbl_notes WHERE id = ?", (note_id,))
-    row = cursor.fetchone()
-    cursor.close()
-    db.close()
-    if row:
-        return dict(id=row[0], title=row[1], content=row[2], created_at=row[3], updated_at=row[4])
+async def get_note_by_id(note_id: int, request: Request, response: Response, db: Database = Depends(get_database)):
+    async def load():
+        row = await db.fetchone("SELECT * FROM v_notes WHERE id = ?", (note_id,))
+        if row:
+            return dict(id=row[0], title=row[1], content=row[2], created_at=row[3], updated_at=row[4])
+    note = await cache.get_or_load(note_key(note_id), load, await table_version(db, "tbl_notes"))
+    if note:
+        return item_not_modified(request, response, note, http_date(note["updated_at"])) or note
     raise HTTPException(status_code=404, detail="Note not found")
 
+def update_note_row(db, note_id, note):
+    # A write function. Writes through v_notes report no rowcount, so the
+    # row is looked up first, in the same write.
+    if db.execute("SELECT 1 FROM tbl_notes WHERE id = ?", (note_id,)).fetchone() is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    query = "UPDATE v_notes SET title = ?, content = ?, updated_at = datetime('now') WHERE id = ?"
+    db.execute(query, (note.title, note.content, note_id))
+
 @app.put("/notes/{note_id}")
-def update_note(note_id: int, note: Note):
-    db = get_db_connection()
-    cursor = db.cursor()
-    query = "UPDATE tbl_notes SET title = ?, content = ?, updated_at = datetime('now') WHERE id = ?"
-    cursor.execute(query, (note.title, note.content, note_id))
-    db.commit()
-    cursor.close()
-    db.close()
+async def update_note(note_id: int, note: Note, db: Database = Depends(get_database)):
+    await db.write(update_note_row, note_id, note)
+    cache.invalidate(note_key(note_id), RECENT_NOTES_KEY)
     return {"message": "Note updated successfully"}
 
 @app.delete("/notes/{note_id}")
-def delete_note_by_id(note_id: int):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("DELETE FROM tbl_notes WHERE id = ?", (note_id,))
-    db.commit()
-    cursor.close()
-    db.close()
+async def delete_note_by_id(note_id: int, db: Database = Depends(get_database)):
+    await db.execute("DELETE FROM v_notes WHERE id = ?", (note_id,))
+    cache.invalidate(note_key(note_id), NOTE_COUNT_KEY, RECENT_NOTES_KEY)
     return {"message": "Note deleted successfully"}
 
+def build_fts_query(text, column=None, prefix=True):
+    # Every word becomes a quoted phrase so user input can never be parsed as
+    # FTS5 syntax; phrases are implicitly ANDed.
+    phrases = ['"' + word.replace('"', '""') + '"' + ("*" if prefix else "") for word in text.split()]
+    if not phrases:
+        return None
+    query = " ".join(phrases)
+    if column:
+        query = f"{column} : ({query})"
+    return query
+
+SEARCH_COLUMNS = NOTE_COLUMNS + ["snippet", "rank"]
+SEARCH_EXPRESSIONS = {
+    "snippet": "snippet(tbl_notes_fts, -1, :highlight_start, :highlight_end, '…', :snippet_words) AS snippet",
+    "rank": "bm25(tbl_notes_fts, 10.0, 1.0) AS rank",
+}
+
+def search_query(columns, preview=None):
+    # Results are ranked by bm25 whether or not rank is among the columns
+    expressions = [SEARCH_EXPRESSIONS.get(column) or note_select(column, preview, "n.", ":preview") for column in columns]
+    return f"""
+    SELECT {', '.join(expressions)}
+    FROM tbl_notes_fts
+    JOIN {notes_source(columns)} n ON n.id = tbl_notes_fts.rowid
+    WHERE tbl_notes_fts MATCH :match
+    ORDER BY bm25(tbl_notes_fts, 10.0, 1.0)
+    LIMIT :limit OFFSET :offset
+"""
+
+SEARCH_QUERY = search_query(SEARCH_COLUMNS)
+
 @app.get("/notes/search/")
-def search_notes_by_title(title: str):
-    db = get_db_connection()
-    cursor = db.cursor()
-    query = "SELECT * FROM tbl_notes WHERE title LIKE ?"
-    cursor.execute(query, ('%' + title + '%',))
-    notes = [dict(id=row[0], title=row[1], content=row[2], created_at=row[3], updated_at=row[4]) for row in cursor.fetchall()]
-    cursor.close()
-    db.close()
-    return notes
+async def search_notes_by_title(
+    response: Response,
+    title: Optional[str] = None,
+    q: Optional[str] = None,
+    prefix: bool = True,
+    highlight_start: str = "[",
+    highlight_end: str = "]",
+    snippet_words: int = Query(12, ge=1, le=64),
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    fields: Optional[str] = None,
+    preview: Optional[int] = Query(None, ge=1, le=NOTE_PREVIEW_MAX),
+    db: Database = Depends(get_database),
+):
+    # `title` searches titles only; `q` searches titles and content. When both
+    # are given a note has to match both.
+    columns = note_fields(fields, SEARCH_COLUMNS)
+    parts = [build_fts_query(title, "title", prefix) if title else None, build_fts_query(q, None, prefix) if q else None]
+    parts = [part for part in parts if part]
+    if not parts:
+        return []
+    match = " AND ".join(f"({part})" for part in parts)
+    params = dict(
+        highlight_start=highlight_start, highlight_end=highlight_end, snippet_words=snippet_words,
+        match=match, limit=limit + 1, offset=offset, preview=preview,
+    )
+    rows = await db.fetchall(search_query(columns, preview), params)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Offset"] = str(offset + limit)
+    return rows_response(columns, rows, response)
 
 @app.get("/notes/count/")
-def get_note_count():
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT COUNT(*) FROM tbl_notes")
-    count = cursor.fetchone()[0]
-    cursor.close()
-    db.close()
-    return {"total_notes": count}
+async def get_note_count(db: Database = Depends(get_database)):
+    async def load():
+        count = (await db.fetchone("SELECT COUNT(*) FROM tbl_notes"))[0]
+        return {"total_notes": count}
+    return await cache.get_or_load(NOTE_COUNT_KEY, load, await table_version(db, "tbl_notes"))
+
+RECENT_NOTES_QUERY = "SELECT * FROM v_notes ORDER BY updated_at DESC LIMIT 5"
 
 @app.get("/notes/recent/")
-def get_recently_updated_notes():
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM tbl_notes ORDER BY updated_at DESC LIMIT 5")
-    notes = [dict(id=row[0], title=row[1], content=row[2], created_at=row[3], updated_at=row[4]) for row in cursor.fetchall()]
-    cursor.close()
-    db.close()
-    return notes
+async def get_recently_updated_notes(
+    request: Request,
+    response: Response,
+    fields: Optional[str] = None,
+    preview: Optional[int] = Query(None, ge=1, le=NOTE_PREVIEW_MAX),
+    db: Database = Depends(get_database),
+):
+    columns = note_fields(fields)
+    unchanged = await collection_not_modified(request, response, db, "tbl_notes")
+    if unchanged:
+        return unchanged
 
-@app.delete("/notes/bulk-delete/")
-def bulk_delete_notes(ids: List[int]):
-    db = get_db_connection()
-    cursor = db.cursor()
-    format_strings = ','.join(['?'] * len(ids))
-    cursor.execute(f"DELETE FROM tbl_notes WHERE id IN ({format_strings})", tuple(ids))
-    db.commit()
-    cursor.close()
-    db.close()
-    return {"message": "Notes deleted successfully"}
+    async def load():
+        rows = await db.fetchall(RECENT_NOTES_QUERY)
+        return [dict(id=row[0], title=row[1], content=row[2], created_at=row[3], updated_at=row[4]) for row in rows]
+    notes = await cache.get_or_load(RECENT_NOTES_KEY, load, await table_version(db, "tbl_notes"))
+    # Projections are cut from the one cached list, so invalidating it
+    # covers them all
+    if fields is None and preview is None:
+        return notes
+    return [project_note(note, columns, preview) for note in notes]
+
+@app.post("/notes/bulk")
+async def bulk_create_notes(request: Request, db: Database = Depends(get_database)):
+    try:
+        return await bulk_insert(db, request, Note, "tbl_notes", INSERT_NOTE_QUERY, lambda note: (note.title, note.content))
+    finally:
+        # Earlier chunks may have committed even if a later one failed
+        cache.invalidate(NOTE_COUNT_KEY, RECENT_NOTES_KEY)
 
 # Timer Management
 
-@app.post("/timers/")
-def create_timer(timer: Timer):
-    db = get_db_connection()
-    cursor = db.cursor()
-    duration = int((timer.end_time - timer.start_time).total_seconds())
-    query = "INSERT INTO tbl_timers (task_name, start_time, end_time, duration) VALUES (?, ?, ?, ?)"
-    cursor.execute(query, (timer.task_name, timer.start_time, timer.end_time, duration))
-    db.commit()
-    cursor.close()
-    db.close()
-    return {"message": "Timer created successfully"}
+INSERT_TIMER_QUERY = "INSERT INTO tbl_timers (task_name, start_time, end_time, duration) VALUES (?, ?, ?, ?)"
 
-@app.get("/timers/")
-def get_all_timers():
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM tbl_timers")
-    timers = [dict(id=row[0], task_name=row[1], start_time=row[2], end_time=row[3], duration=row[4]) for row in cursor.fetchall()]
-    cursor.close()
-    db.close()
-    return timers
+def timer_duration(start_time, end_time):
+    if end_time is None:
+        return None
+    return int((end_time - start_time).total_seconds())
 
-@app.get("/timers/{timer_id}")
-def get_timer_by_id(timer_id: int):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM tbl_timers WHERE id = ?", (timer_id,))
-    row = cursor.fetchone()
-    cursor.close()
-    db.close()
-    if row:
-        return dict(id=row[0], task_name=row[1], start_time=row[2], end_time=row[3], duration=row[4])
-    raise HTTPException(status_code=404, detail="Timer not found")
+# Timers are stored as naive UTC to the second, "YYYY-MM-DD HH:MM:SS" like
+# SQLite's datetime('now'), so times from clients with any offset compare
+# correctly as text
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
 
-@app.put("/timers/{timer_id}")
-def update_timer(timer_id: int, timer: Timer):
-    db = get_db_connection()
-    cursor = db.cursor()
-    duration = int((timer.end_time - timer.start_time).total_seconds())
-    query = "UPDATE tbl_timers SET task_name = ?, start_time = ?, end_time = ?, duration = ? WHERE id = ?"
-    cursor.execute(query, (timer.task_name, timer.start_time, timer.end_time, duration, timer_id))
-    db.commit()
-    cursor.close()
-    db.close()
-    return {"message": "Timer updated successfully"}
+def as_utc(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.replace(microsecond=0)
 
-@app.delete("/timers/{timer_id}")
-def delete_timer_by_id(timer_id: int):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("DELETE FROM tbl_timers WHERE id = ?", (timer_id,))
-    db.commit()
-    cursor.close()
-    db.close()
-    return {"message": "Timer deleted successfully"}
+def stored_time(value):
+    # The text of an as_utc() value, as it is bound and read back
+    return value.isoformat(" ") if value is not None else None
 
-@app.get("/timers/active/")
-def get_active_timers():
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM tbl_timers WHERE end_time IS NULL")
-    timers = [dict(id=row[0], task_name=row[1], start_time=row[2], end_time=row[3], duration=row[4]) for row in cursor.fetchall()]
-    cursor.close()
-    db.close()
-    return timers
-
-# Timer Management
+def timer_row(timer):
+    start_time = as_utc(timer.start_time)
+    end_time = as_utc(timer.end_time) if timer.end_time else None
+    return (timer.task_name, stored_time(start_time), stored_time(end_time), timer_duration(start_time, end_time))
 
 @app.post("/timers/")
-def create_timer(timer: Timer):
-    db = get_db_connection()
-    cursor = db.cursor()
-    duration = int((timer.end_time - timer.start_time).total_seconds())
-    query = """
-        INSERT INTO tbl_timers (task_name, start_time, end_time, duration)
-        VALUES (?, ?, ?, ?)
-    """
-    cursor.execute(query, (timer.task_name, timer.start_time, timer.end_time, duration))
-    db.commit()
-    cursor.close()
-    db.close()
+async def create_timer(timer: Timer, db: Database = Depends(get_database)):
+    await db.execute(INSERT_TIMER_QUERY, timer_row(timer))
+    cache.invalidate(AVERAGE_DURATION_KEY)
     return {"message": "Timer created successfully"}
 
+@app.post("/timers/bulk")
+async def bulk_create_timers(request: Request, db: Database = Depends(get_database)):
+    try:
+        return await bulk_insert(db, request, Timer, "tbl_timers", INSERT_TIMER_QUERY, timer_row)
+    finally:
+        cache.invalidate(AVERAGE_DURATION_KEY)
+
 @app.get("/timers/")
-def get_all_timers():
-    db = get_db_connection()
-    cursor = db.cursor()
-    query = "SELECT * FROM tbl_timers"
-    cursor.execute(query)
-    timers = cursor.fetchall()
-    cursor.close()
-    db.close()
-    # Convert results to a list of dictionaries
-    keys = ["id", "task_name", "start_time", "end_time", "duration"]
-    return [dict(zip(keys, timer)) for timer in timers]
+async def get_all_timers(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    order: Literal["id", "start_time"] = "id",
+    format: Literal["json", "columns", "ndjson", "csv"] = "json",
+    db: Database = Depends(get_database),
+):
+    return (
+        await collection_not_modified(request, response, db, "tbl_timers")
+        or await list_rows(db, "tbl_timers", TIMER_COLUMNS, order, after, limit, format, response)
+    )
 
 @app.get("/timers/{timer_id}")
-def get_timer_by_id(timer_id: int):
-    db = get_db_connection()
-    cursor = db.cursor()
+async def get_timer_by_id(timer_id: int, request: Request, response: Response, db: Database = Depends(get_database)):
     query = "SELECT * FROM tbl_timers WHERE id = ?"
-    cursor.execute(query, (timer_id,))
-    timer = cursor.fetchone()
-    cursor.close()
-    db.close()
+    timer = await db.fetchone(query, (timer_id,))
     if timer:
         keys = ["id", "task_name", "start_time", "end_time", "duration"]
-        return dict(zip(keys, timer))
+        timer = dict(zip(keys, timer))
+        return item_not_modified(request, response, timer) or timer
     raise HTTPException(status_code=404, detail="Timer not found")
 
 @app.put("/timers/{timer_id}")
-def update_timer(timer_id: int, timer: Timer):
-    db = get_db_connection()
-    cursor = db.cursor()
-    duration = int((timer.end_time - timer.start_time).total_seconds())
+async def update_timer(timer_id: int, timer: Timer, db: Database = Depends(get_database)):
     query = """
         UPDATE tbl_timers
         SET task_name = ?, start_time = ?, end_time = ?, duration = ?
         WHERE id = ?
     """
-    cursor.execute(query, (timer.task_name, timer.start_time, timer.end_time, duration, timer_id))
-    db.commit()
-    cursor.close()
-    db.close()
+    cursor = await db.execute(query, (*timer_row(timer), timer_id))
+    if not cursor.rowcount:
+        raise HTTPException(status_code=404, detail="Timer not found")
+    cache.invalidate(AVERAGE_DURATION_KEY)
     return {"message": "Timer updated successfully"}
 
 @app.delete("/timers/{timer_id}")
-def delete_timer_by_id(timer_id: int):
-    db = get_db_connection()
-    cursor = db.cursor()
+async def delete_timer_by_id(timer_id: int, db: Database = Depends(get_database)):
     query = "DELETE FROM tbl_timers WHERE id = ?"
-    cursor.execute(query, (timer_id,))
-    db.commit()
-    cursor.close()
-    db.close()
+    await db.execute(query, (timer_id,))
+    cache.invalidate(AVERAGE_DURATION_KEY)
     return {"message": "Timer deleted successfully"}
 
+# Bulk Updates and Deletes
+
+# Any number of ids, or every row a filter matches, changed in chunks of
+# jobs.chunk_size with one write per chunk. With ?background=true the
+# request returns 202 at once and the job's progress is at GET /jobs/{id}.
+# Archived timers are not touched.
+async def run_bulk(db, mutation, background, response, message):
+    if background:
+        response.status_code = 202
+        return {"message": "Bulk job started", "job": await jobs.start(db, mutation)}
+    return {"message": message, "job": await jobs.run(db, mutation)}
+
+def filter_where(where, conditions):
+    if where.ids is None and not conditions:
+        raise HTTPException(status_code=400, detail="Give ids or at least one filter")
+    return " AND ".join(conditions) or "1"
+
+def note_filter(where):
+    conditions, params = [], {}
+    if where.title is not None:
+        params["title"] = build_fts_query(where.title, "title")
+        if params["title"] is None:
+            raise HTTPException(status_code=400, detail="title has no words to match")
+        conditions.append(
+            "id IN (SELECT rowid FROM tbl_notes_fts WHERE tbl_notes_fts MATCH :title AND rowid BETWEEN :first AND :last)"
+        )
+    if where.updated_start is not None:
+        conditions.append("updated_at >= :updated_start")
+        params["updated_start"] = stored_time(as_utc(where.updated_start))
+    if where.updated_end is not None:
+        conditions.append("updated_at <= :updated_end")
+        params["updated_end"] = stored_time(as_utc(where.updated_end))
+    return filter_where(where, conditions), params
+
+def timer_filter(where):
+    conditions, params = [], {}
+    if where.task_name is not None:
+        conditions.append("task_name = :task_name")
+        params["task_name"] = where.task_name
+    if where.start is not None:
+        conditions.append("start_time >= :start")
+        params["start"] = stored_time(as_utc(where.start))
+    if where.end is not None:
+        conditions.append("start_time <= :end")
+        params["end"] = stored_time(as_utc(where.end))
+    return filter_where(where, conditions), params
+
+def notes_deleted(ids):
+    cache.invalidate(*map(note_key, ids), NOTE_COUNT_KEY, RECENT_NOTES_KEY)
+
+def notes_updated(ids):
+    cache.invalidate(*map(note_key, ids), RECENT_NOTES_KEY)
+
+def timers_changed(ids):
+    cache.invalidate(AVERAGE_DURATION_KEY)
+
+@app.delete("/notes/bulk-delete/")
+async def bulk_delete_notes(
+    response: Response,
+    where: Union[List[int], NoteFilter] = Body(...),
+    background: bool = False,
+    db: Database = Depends(get_database),
+):
+    # The body is a list of ids or a NoteFilter
+    if isinstance(where, list):
+        where = NoteFilter(ids=where)
+    condition, params = note_filter(where)
+    mutation = BulkMutation(
+        "delete notes", "tbl_notes", f"DELETE FROM v_notes WHERE id IN ({CHUNK_IDS})",
+        condition, params, where.ids, notes_deleted,
+    )
+    return await run_bulk(db, mutation, background, response, "Notes deleted successfully")
+
+@app.patch("/notes/bulk-update/")
+async def bulk_update_notes(
+    update: NoteBulkUpdate, response: Response, background: bool = False, db: Database = Depends(get_database)
+):
+    if update.set.title is None and update.set.content is None:
+        raise HTTPException(status_code=400, detail="Nothing to set")
+    condition, params = note_filter(update.where)
+    statement = f"""
+        UPDATE v_notes
+        SET title = COALESCE(:set_title, title), content = COALESCE(:set_content, content), updated_at = datetime('now')
+        WHERE id IN ({CHUNK_IDS})
+    """
+    params.update(set_title=update.set.title, set_content=update.set.content)
+    mutation = BulkMutation("update notes", "tbl_notes", statement, condition, params, update.where.ids, notes_updated)
+    return await run_bulk(db, mutation, background, response, "Notes updated successfully")
+
+@app.delete("/timers/bulk-delete/")
+async def bulk_delete_timers(
+    response: Response,
+    where: Union[List[int], TimerFilter] = Body(...),
+    background: bool = False,
+    db: Database = Depends(get_database),
+):
+    # The body is a list of ids or a TimerFilter
+    if isinstance(where, list):
+        where = TimerFilter(ids=where)
+    condition, params = timer_filter(where)
+    mutation = BulkMutation(
+        "delete timers", "tbl_timers", f"DELETE FROM tbl_timers WHERE id IN ({CHUNK_IDS})",
+        condition, params, where.ids, timers_changed,
+    )
+    return await run_bulk(db, mutation, background, response, "Timers deleted successfully")
+
+@app.patch("/timers/bulk-update/")
+async def bulk_update_timers(
+    update: TimerBulkUpdate, response: Response, background: bool = False, db: Database = Depends(get_database)
+):
+    condition, params = timer_filter(update.where)
+    params["set_task_name"] = update.set.task_name
+    mutation = BulkMutation(
+        "update timers", "tbl_timers", f"UPDATE tbl_timers SET task_name = :set_task_name WHERE id IN ({CHUNK_IDS})",
+        condition, params, update.where.ids, timers_changed,
+    )
+    return await run_bulk(db, mutation, background, response, "Timers updated successfully")
+
+@app.get("/jobs/")
+async def get_jobs(db: Database = Depends(get_database)):
+    return await jobs.all(db)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, db: Database = Depends(get_database)):
+    job = await jobs.get(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, db: Database = Depends(get_database)):
+    # Stops the job before its next chunk, in whichever worker runs it;
+    # what it already changed stays
+    job = await jobs.cancel(db, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job is False:
+        raise HTTPException(status_code=409, detail="Job has already finished")
+    return job
+
+# Live Timers
+
+def stop_timer_row(db, timer_id, end_time):
+    row = db.execute("SELECT task_name, start_time, end_time FROM tbl_timers WHERE id = ?", (timer_id,)).fetchone()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Timer not found")
+    task_name, start_time, stopped_at = row
+    if stopped_at is not None:
+        raise HTTPException(status_code=409, detail="Timer is already stopped")
+    duration = timer_duration(as_utc(start_time), end_time)
+    if duration < 0:
+        raise HTTPException(status_code=422, detail="end_time is before the timer's start_time")
+    end_time = stored_time(end_time)
+    db.execute("UPDATE tbl_timers SET end_time = ?, duration = ? WHERE id = ?", (end_time, duration, timer_id))
+    return dict(zip(TIMER_COLUMNS, (timer_id, task_name, start_time, end_time, duration)))
+
+@app.post("/timers/start")
+async def start_timer(timer: TimerStart, db: Database = Depends(get_database)):
+    start_time = stored_time(as_utc(timer.start_time) if timer.start_time else utc_now())
+    cursor = await db.execute(INSERT_TIMER_QUERY, (timer.task_name, start_time, None, None))
+    # Running timers have no duration, so the aggregates are unaffected
+    return dict(zip(TIMER_COLUMNS, (cursor.lastrowid, timer.task_name, start_time, None, None)))
+
+@app.post("/timers/{timer_id}/stop")
+async def stop_timer(timer_id: int, timer: Optional[TimerStop] = None, db: Database = Depends(get_database)):
+    end_time = as_utc(timer.end_time) if timer and timer.end_time else utc_now()
+    stopped = await db.write(stop_timer_row, timer_id, end_time)
+    cache.invalidate(AVERAGE_DURATION_KEY)
+    return stopped
+
+ACTIVE_TIMERS_QUERY = "SELECT * FROM tbl_timers WHERE end_time IS NULL"
+
 @app.get("/timers/active/")
-def get_active_timers():
-    db = get_db_connection()
-    cursor = db.cursor()
-    query = "SELECT * FROM tbl_timers WHERE end_time IS NULL"
-    cursor.execute(query)
-    timers = cursor.fetchall()
-    cursor.close()
-    db.close()
-    keys = ["id", "task_name", "start_time", "end_time", "duration"]
-    return [dict(zip(keys, timer)) for timer in timers]
+async def get_active_timers(request: Request, response: Response, db: Database = Depends(get_database)):
+    unchanged = await collection_not_modified(request, response, db, "tbl_timers")
+    if unchanged:
+        return unchanged
+    return rows_response(TIMER_COLUMNS, await db.fetchall(ACTIVE_TIMERS_QUERY), response)
+
+# Durations are read from the trigger-maintained aggregate tables
+TOTAL_TIME_QUERY = "SELECT total FROM tbl_timer_task_stats WHERE task_name = ?"
 
 @app.get("/timers/duration/")
-def calculate_total_time(task_name: str):
-    db = get_db_connection()
-    cursor = db.cursor()
-    query = "SELECT SUM(duration) FROM tbl_timers WHERE task_name = ?"
-    cursor.execute(query, (task_name,))
-    total_duration = cursor.fetchone()[0]
-    cursor.close()
-    db.close()
+async def calculate_total_time(task_name: str, db: Database = Depends(get_database)):
+    row = await db.fetchone(TOTAL_TIME_QUERY, (task_name,))
+    total_duration = row[0] if row else None
     return {"total_duration_seconds": total_duration}
 
+AVERAGE_DURATION_QUERY = "SELECT CAST(SUM(total) AS REAL) / SUM(count) FROM tbl_timer_task_stats"
+
 @app.get("/timers/average-duration/")
-def get_average_duration():
-    db = get_db_connection()
-    cursor = db.cursor()
-    query = "SELECT AVG(duration) FROM tbl_timers"
-    cursor.execute(query)
-    avg_duration = cursor.fetchone()[0]
-    cursor.close()
-    db.close()
-    return {"average_duration_seconds": avg_duration}
+async def get_average_duration(db: Database = Depends(get_database)):
+    async def load():
+        avg_duration = (await db.fetchone(AVERAGE_DURATION_QUERY))[0]
+        return {"average_duration_seconds": avg_duration}
+    return await cache.get_or_load(AVERAGE_DURATION_KEY, load, await table_version(db, "tbl_timers"))
+
+STATS_KEYS = ["count", "total", "minimum", "maximum", "total_squares"]
+
+def describe_stats(row):
+    stats = dict(zip(STATS_KEYS, row))
+    count, total = stats["count"], stats["total"]
+    mean = total / count
+    # Population variance from the running sums; clamp float rounding noise
+    stats["mean"] = mean
+    stats["variance"] = max(stats.pop("total_squares") / count - mean * mean, 0.0)
+    return stats
+
+TASK_STATS_QUERY = f"SELECT task_name, {', '.join(STATS_KEYS)} FROM tbl_timer_task_stats ORDER BY task_name"
+
+DAILY_STATS_QUERY = f"""
+    SELECT day, {', '.join(STATS_KEYS)} FROM tbl_timer_daily_stats
+    WHERE task_name = ? AND day BETWEEN ? AND ?
+    ORDER BY day
+"""
+
+ALL_TASKS_DAILY_STATS_QUERY = """
+    SELECT day, SUM(count), SUM(total), MIN(minimum), MAX(maximum), SUM(total_squares)
+    FROM tbl_timer_daily_stats
+    WHERE day BETWEEN ? AND ?
+    GROUP BY day
+    ORDER BY day
+"""
+
+@app.get("/timers/tasks/")
+async def get_task_breakdown(db: Database = Depends(get_database)):
+    rows = await db.fetchall(TASK_STATS_QUERY)
+    return [dict(task_name=row[0], **describe_stats(row[1:])) for row in rows]
+
+@app.get("/timers/daily/")
+async def get_daily_breakdown(
+    task_name: Optional[str] = None,
+    start: date = date.min,
+    end: date = date.max,
+    db: Database = Depends(get_database),
+):
+    if task_name is None:
+        rows = await db.fetchall(ALL_TASKS_DAILY_STATS_QUERY, (start.isoformat(), end.isoformat()))
+    else:
+        rows = await db.fetchall(DAILY_STATS_QUERY, (task_name, start.isoformat(), end.isoformat()))
+    return [dict(day=row[0], **describe_stats(row[1:])) for row in rows]
+
+# Routes a range to the archive parts that overlap it and to tbl_timers,
+# in one statement so both come from the same snapshot. A part shows up as
+# a row with its file name first; tbl_timers rows have NULL there. UNION
+# ALL returns its arms in order, so parts come before any timer.
+TIMERS_IN_RANGE_QUERY = """
+    SELECT file, NULL, NULL, NULL, NULL, NULL FROM tbl_timer_archive
+    WHERE first_start <= :end AND last_start >= :start
+    UNION ALL
+    SELECT NULL, * FROM tbl_timers
+    WHERE start_time BETWEEN :start AND :end
+"""
+
+async def with_archived(rows, bounds):
+    # Replaces each part row with the part's timers in range
+    parts = 0
+    while parts < len(rows) and rows[parts][0] is not None:
+        parts += 1
+    if not parts:
+        return rows
+    expanded = []
+    for row in rows[:parts]:
+        timers = await asyncio.to_thread(archive.read, row[0], *bounds)
+        expanded.extend((None, *timer) for timer in timers)
+    expanded.extend(rows[parts:])
+    return expanded
+
+# The range stream pages tbl_timers by (start_time, id) instead. Each page
+# also lists the parts archived since the previous one, from the same
+# snapshot, as their timers have left tbl_timers by then.
+RANGE_PARTS_QUERY = """
+    SELECT id, file FROM tbl_timer_archive
+    WHERE first_start <= :end AND last_start >= :start AND id > :part
+    ORDER BY id
+"""
+
+def read_range_page(db, start, end, part, key):
+    # A read function: parts with ids above `part` and the timers in range
+    # after `key`, from one read transaction
+    db.execute("BEGIN")
+    try:
+        parts = db.execute(RANGE_PARTS_QUERY, {"start": start, "end": end, "part": part}).fetchall()
+        query, params = keyset_query(
+            "tbl_timers", TIMER_COLUMNS, "start_time", None, STREAM_BATCH_SIZE,
+            "start_time BETWEEN ? AND ?", (start, end), key,
+        )
+        started = time.perf_counter()
+        rows = db.execute(query, params).fetchall()
+        observe_statement(query, time.perf_counter() - started, len(rows))
+        return parts, rows
+    finally:
+        db.rollback()
+
+async def stream_range(db, start, end):
+    # Timers in a part archived mid-stream that sort before `key` were
+    # already sent from tbl_timers, so only the rest of the part is
+    part = 0
+    key = None
+    while True:
+        parts, rows = await db.read(read_range_page, start, end, part, key)
+        for part, file in parts:
+            timers = await asyncio.to_thread(archive.read, file, start, end)
+            if key is not None:
+                timers = [timer for timer in timers if (timer[2], timer[0]) > key]
+            if timers:
+                yield timers
+        if rows:
+            yield [row[2:] for row in rows]
+        if len(rows) < STREAM_BATCH_SIZE:
+            return
+        key = rows[-1][0], rows[-1][1]
 
 @app.get("/timers/range/")
-def get_timers_in_range(start: datetime, end: datetime):
-    db = get_db_connection()
-    cursor = db.cursor()
-    query = """
-        SELECT * FROM tbl_timers
-        WHERE start_time BETWEEN ? AND ?
+async def get_timers_in_range(
+    start: datetime,
+    end: datetime,
+    request: Request,
+    response: Response,
+    format: Literal["json", "columns", "ndjson", "csv"] = "json",
+    db: Database = Depends(get_database),
+):
+    unchanged = await collection_not_modified(request, response, db, "tbl_timers")
+    if unchanged:
+        return unchanged
+    # Bound as stored text, so offsets are compared in UTC
+    start, end = stored_time(as_utc(start)), stored_time(as_utc(end))
+    if format in STREAM_FORMATS:
+        return stream_rows(stream_range(db, start, end), TIMER_COLUMNS, format, response)
+    rows = await with_archived(await db.fetchall(TIMERS_IN_RANGE_QUERY, {"start": start, "end": end}), (start, end))
+    return encode_rows(format)(TIMER_COLUMNS, rows, response, skip=1)
+
+# Timer statistics over a time range, grouped in SQL. Percentiles use the
+# nearest-rank method: the smallest duration whose cumulative share of its
+# group (CUME_DIST) is at least p. One window means one sort of the range.
+# Running timers are left out. Ranges of whole days that are not bucketed
+# by hour take everything but the percentiles from tbl_timer_daily_stats.
+STATS_BUCKETS = {
+    "hour": "strftime('%Y-%m-%d %H:00:00', start_time)",
+    "day": "substr(start_time, 1, 10)",
+    # The Monday on or before start_time
+    "week": "date(start_time, '-6 days', 'weekday 1')",
+}
+STATS_PERCENTILES = {"p50": 0.5, "p95": 0.95}
+STATS_AGGREGATES = ["count", "total", "mean", "minimum", "maximum"]
+# The same buckets over tbl_timer_daily_stats' day
+ROLLUP_BUCKETS = {
+    "day": "day",
+    "week": "date(day, '-6 days', 'weekday 1')",
+}
+# Seconds a stats read may scan timers before it is interrupted, and the
+# SQLite VM steps between looks at the clock
+STATS_TIMEOUT = float(os.environ.get("MEMOTIME_STATS_TIMEOUT", 10))
+STATS_PROGRESS_STEPS = 10000
+
+# Archived timers in range are loaded into a temp table on the reading
+# connection and read alongside tbl_timers
+ARCHIVED_TIMERS_TABLE = "CREATE TEMP TABLE archived_timers (id, task_name, start_time, end_time, duration)"
+WITH_ARCHIVED_TIMERS = """(
+    SELECT task_name, start_time, duration FROM tbl_timers
+    UNION ALL
+    SELECT task_name, start_time, duration FROM temp.archived_timers
+)"""
+
+def stats_groups(buckets, bucket, by_task):
+    groups = ([f"{buckets[bucket]} AS bucket"] if bucket else []) + (["task_name"] if by_task else [])
+    return groups, [group.split(" AS ")[-1] for group in groups]
+
+def timer_stats_query(bucket=None, by_task=False, task_name=None, source="tbl_timers", aggregates=True, percentiles=True):
+    # Returns the query and its result columns; the parameters are
+    # (start, end) followed by task_name when filtering on it
+    # Without percentiles there is nothing to rank, so nothing is sorted
+    groups, keys = stats_groups(STATS_BUCKETS, bucket, by_task)
+    partition = f"PARTITION BY {', '.join(keys)} " if keys else ""
+    selected = list(keys)
+    if aggregates:
+        selected += [
+            "COUNT(*) AS count", "SUM(duration) AS total", "AVG(duration) AS mean",
+            "MIN(duration) AS minimum", "MAX(duration) AS maximum",
+        ]
+    if percentiles:
+        selected += [
+            f"MIN(CASE WHEN share >= {fraction} THEN duration END) AS {name}"
+            for name, fraction in STATS_PERCENTILES.items()
+        ]
+    query = f"""
+        WITH selected AS (
+            SELECT {''.join(group + ', ' for group in groups)}duration
+            FROM {source}
+            WHERE start_time >= ? AND start_time < ? AND duration IS NOT NULL{" AND task_name = ?" if task_name else ""}
+        ), ranked AS (
+            SELECT *, CUME_DIST() OVER ({partition}ORDER BY duration) AS share
+            FROM selected
+        )
+        SELECT {', '.join(selected)}
+        FROM {"ranked" if percentiles else "selected"}
+    """
+    if keys:
+        query += f" GROUP BY {', '.join(keys)} ORDER BY {', '.join(keys)}"
+    else:
+        # An empty range still yields one row of NULLs without this
+        query += " HAVING COUNT(*) > 0"
+    return query, keys + (STATS_AGGREGATES if aggregates else []) + (list(STATS_PERCENTILES) if percentiles else [])
+
+def rollup_stats_query(bucket=None, by_task=False, task_name=None):
+    # timer_stats_query's aggregates from the daily rollup; the parameters
+    # are the first day and the day after the last, then task_name
+    groups, keys = stats_groups(ROLLUP_BUCKETS, bucket, by_task)
+    query = f"""
+        SELECT {''.join(group + ', ' for group in groups)}SUM(count) AS count, SUM(total) AS total,
+               CAST(SUM(total) AS REAL) / SUM(count) AS mean, MIN(minimum) AS minimum, MAX(maximum) AS maximum
+        FROM tbl_timer_daily_stats
+        WHERE day >= ? AND day < ?{" AND task_name = ?" if task_name else ""}
     """
-    cursor.execute(query, (start, end))
-    timers = cursor.fetchall()
-    cursor.close()
-    db.close()
-    keys = ["id", "task_name", "start_time", "end_time", "duration"]
-    return [dict(zip(keys, timer)) for timer in timers]
+    if keys:
+        query += f" GROUP BY {', '.join(keys)} HAVING SUM(count) > 0 ORDER BY {', '.join(keys)}"
+    else:
+        query += " HAVING SUM(count) > 0"
+    return query, keys + STATS_AGGREGATES
+
+def whole_days(start, end):
+    return start.time() == end.time() == datetime.min.time()
+
+def run_stats_query(db, query, params):
+    started = time.perf_counter()
+    rows = db.execute(query, params).fetchall()
+    observe_statement(query, time.perf_counter() - started, len(rows))
+    return rows
+
+def scan_timer_stats(db, bucket, by_task, task_name, start, end, aggregates, percentiles):
+    # Reads the timers themselves, archived ones through a temp table
+    bounds = stored_time(start), stored_time(end)
+    files = archive.parts(db, *bounds)
+    source = "tbl_timers"
+    if files:
+        db.execute(ARCHIVED_TIMERS_TABLE)
+        for file in files:
+            db.executemany("INSERT INTO archived_timers VALUES (?, ?, ?, ?, ?)", archive.read(file, *bounds))
+        source = WITH_ARCHIVED_TIMERS
+    query, columns = timer_stats_query(bucket, by_task, task_name, source, aggregates, percentiles)
+    return columns, run_stats_query(db, query, (*bounds, task_name) if task_name else bounds)
+
+def read_timer_stats(db, bucket, by_task, task_name, start, end, percentiles):
+    # A read function. The part list and the stats come from one read
+    # transaction, so a chunk archived meanwhile is counted exactly once.
+    # The rollup rows are joined with the scanned percentiles on the group
+    # keys, which both derive from the same start_time text.
+    deadline = time.monotonic() + STATS_TIMEOUT
+    db.set_progress_handler(lambda: time.monotonic() > deadline, STATS_PROGRESS_STEPS)
+    db.execute("BEGIN")
+    try:
+        if bucket == "hour" or not whole_days(start, end):
+            return scan_timer_stats(db, bucket, by_task, task_name, start, end, True, percentiles)
+        query, columns = rollup_stats_query(bucket, by_task, task_name)
+        days = (start.date().isoformat(), end.date().isoformat())
+        rows = run_stats_query(db, query, (*days, task_name) if task_name else days)
+        if not percentiles or not rows:
+            return columns + (list(STATS_PERCENTILES) if percentiles else []), rows
+        keys = len(columns) - len(STATS_AGGREGATES)
+        _, scanned = scan_timer_stats(db, bucket, by_task, task_name, start, end, False, True)
+        found = {row[:keys]: row[keys:] for row in scanned}
+        missing = (None,) * len(STATS_PERCENTILES)
+        return columns + list(STATS_PERCENTILES), [row + found.get(row[:keys], missing) for row in rows]
+    except sqlite3.OperationalError as e:
+        if "interrupted" not in str(e):
+            raise
+        raise HTTPException(
+            status_code=422,
+            detail=f"Stats took over {STATS_TIMEOUT:g}s; narrow the range or pass percentiles=false",
+        )
+    finally:
+        # Also drops the temp table
+        db.rollback()
+        db.set_progress_handler(None, 0)
+
+@app.get("/timers/stats/")
+async def get_timer_stats(
+    start: datetime,
+    end: datetime,
+    request: Request,
+    response: Response,
+    bucket: Optional[Literal["hour", "day", "week"]] = None,
+    by_task: bool = False,
+    task_name: Optional[str] = None,
+    percentiles: bool = True,
+    format: Literal["json", "columns"] = "json",
+    db: Database = Depends(get_database),
+):
+    # Count, total, mean, min, max, p50 and p95 of duration for timers that
+    # started in [start, end), optionally per bucket and/or per task.
+    # percentiles=false leaves p50 and p95 out, and with them the scan.
+    unchanged = await collection_not_modified(request, response, db, "tbl_timers")
+    if unchanged:
+        return unchanged
+    columns, rows = await db.read(read_timer_stats, bucket, by_task, task_name, as_utc(start), as_utc(end), percentiles)
+    return encode_rows(format)(columns, rows, response)
+
+@app.get("/timers/archive/")
+async def get_timer_archive(db: Database = Depends(get_database)):
+    # Retention settings, the background mover's progress and the archive's
+    # parts per month
+    return {**archive.status(), "months": await db.read(archive.months)}
+
+# Delta Sync
+
+SYNC_QUERY = """
+    SELECT c.seq, c.entity, c.entity_id, c.op,
+           n.title, COALESCE(n.content, inflate(b.body)), n.created_at, n.updated_at,
+           t.task_name, t.start_time, t.end_time, t.duration
+    FROM tbl_changes c
+    LEFT JOIN tbl_notes n ON c.entity = 'note' AND n.id = c.entity_id
+    LEFT JOIN tbl_note_bodies b ON b.note_id = n.id
+    LEFT JOIN tbl_timers t ON c.entity = 'timer' AND t.id = c.entity_id
+    WHERE c.seq > ?
+    ORDER BY c.seq
+    LIMIT ?
+"""
+
+def sync_change(row):
+    seq, entity, entity_id, op = row[:4]
+    change = dict(seq=seq, entity=entity, id=entity_id, op=op)
+    if op != "delete":
+        # Rows are read as they are now, so an entity changed several times
+        # since `since` arrives once with its latest state
+        if entity == "note":
+            change["data"] = dict(zip(NOTE_COLUMNS, (entity_id, *row[4:8])))
+        else:
+            change["data"] = dict(zip(TIMER_COLUMNS, (entity_id, *row[8:12])))
+    return change
+
+@app.get("/sync")
+async def get_changes_since(
+    since: int = Query(0, ge=0),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: Database = Depends(get_database),
+):
+    # Clients store `next` and pass it back as `since` until has_more is false
+    rows = await db.fetchall(SYNC_QUERY, (since, limit + 1))
+    has_more = len(rows) > limit
+    changes = [sync_change(row) for row in rows[:limit]]
+    return {
+        "changes": changes,
+        "next": changes[-1]["seq"] if changes else since,
+        "has_more": has_more,
+    }
+
+# Server-Sent Events
+
+def change_event(change):
+    # The event id is the change's seq, so a reconnecting client resumes
+    # from Last-Event-ID without missing or repeating anything
+    data = json.dumps(change, separators=(",", ":"), default=str)
+    return f"id: {change['seq']}\nevent: {change['entity']}\ndata: {data}\n\n"
+
+async def stream_changes(request, db, since):
+    loop = asyncio.get_running_loop()
+    last_sent = loop.time()
+    closes_at = last_sent + EVENTS_MAX_AGE
+    # Ask the client to come back straight away when the stream ends
+    yield "retry: 1000\n\n"
+    while loop.time() < closes_at and not await request.is_disconnected():
+        event = changes.current()
+        rows = await db.fetchall(SYNC_QUERY, (since, MAX_PAGE_SIZE))
+        if rows:
+            since = rows[-1][0]
+            last_sent = loop.time()
+            yield "".join(change_event(sync_change(row)) for row in rows)
+            if len(rows) == MAX_PAGE_SIZE:
+                continue
+        elif loop.time() - last_sent >= EVENTS_HEARTBEAT:
+            last_sent = loop.time()
+            yield ": keep-alive\n\n"
+        await changes.wait(event, min(EVENTS_POLL_INTERVAL, max(closes_at - loop.time(), 0)))
+
+@app.get("/events")
+async def get_events(
+    request: Request,
+    since: Optional[int] = Query(None, ge=0),
+    db: Database = Depends(get_database),
+):
+    # Pushes note and timer changes as they commit, in the same shape as
+    # GET /sync. Without `since` (or a Last-Event-ID header) the stream
+    # starts from now.
+    last_event_id = request.headers.get("last-event-id")
+    if since is None and last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    if since is None:
+        since = (await db.fetchone("SELECT COALESCE(MAX(seq), 0) FROM tbl_changes"))[0]
+    return StreamingResponse(
+        stream_changes(request, db, since),
+        media_type="text/event-stream",
+        # identity keeps GZipMiddleware from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Content-Encoding": "identity"},
+    )
+
+# Warm Start
+
+def prewarm_statements():
+    # The hot read statements, exactly as the handlers run them, so the
+    # statement cache hits. Parameters only need to be valid.
+    return [
+        (TABLE_VERSION_QUERY, ("tbl_notes",)),
+        ("SELECT * FROM v_notes WHERE id = ?", (1,)),
+        keyset_query("v_notes", NOTE_COLUMNS, "id", None, DEFAULT_PAGE_SIZE + 1),
+        (RECENT_NOTES_QUERY, ()),
+        ("SELECT * FROM tbl_timers WHERE id = ?", (1,)),
+        keyset_query("tbl_timers", TIMER_COLUMNS, "id", None, DEFAULT_PAGE_SIZE + 1),
+        (ACTIVE_TIMERS_QUERY, ()),
+        (TOTAL_TIME_QUERY, ("",)),
+        (AVERAGE_DURATION_QUERY, ()),
+        (TASK_STATS_QUERY, ()),
+        (TIMERS_IN_RANGE_QUERY, {"start": "", "end": ""}),
+        (SYNC_QUERY, (0, 1)),
+    ]
@@ -0,0 +1,204 @@
+import argparse
+import os
+import sqlite3
+import sys
+
+import main
+from archive import ARCHIVE_DIR, TIMER_RETENTION_MONTHS, TimerArchive, retention_cutoff
+from database import DB_PATH, TIMER_STATS_TABLES, migrate, rebuild_timer_stats_statements
+from mutations import JOB_QUERY, PRUNE_JOBS_QUERY, BulkMutation
+
+
+def chunk_check(endpoint, table, where_and_params):
+    # The per-chunk match of a bulk update or delete. The filter's up-front
+    # match is a read that may scan, and is not checked.
+    where, params = where_and_params
+    query = BulkMutation(endpoint, table, "", where, params).match_query
+    return f"{endpoint} (each chunk)", query, {**params, "ids": "[1, 2, 3]", "first": 1, "last": 3}
+
+
+# (endpoint, query, params) for every query that must be served by an index.
+# Whole-table aggregates like COUNT(*) are deliberately not listed.
+PLAN_CHECKS = [
+    ("GET /notes/{note_id}", "SELECT * FROM v_notes WHERE id = ?", (1,)),
+    ("GET /notes/recent/", main.RECENT_NOTES_QUERY, ()),
+    ("GET /notes/?after=", *main.keyset_query("v_notes", main.NOTE_COLUMNS, "id", main.encode_page_token("id", (1, 1)), 100)),
+    (
+        "GET /notes/?order=updated_at&after=",
+        *main.keyset_query(
+            "v_notes", main.NOTE_COLUMNS, "updated_at", main.encode_page_token("updated_at", ("2024-01-01", 1)), 100
+        ),
+    ),
+    (
+        "GET /notes/?fields=id,title&order=updated_at&after=",
+        *main.keyset_query(
+            "tbl_notes", ["id", "title"], "updated_at", main.encode_page_token("updated_at", ("2024-01-01", 1)), 100
+        ),
+    ),
+    (
+        "GET /notes/search/",
+        main.SEARCH_QUERY,
+        dict(highlight_start="[", highlight_end="]", snippet_words=12, match='"note"*', limit=20, offset=0),
+    ),
+    ("GET /timers/{timer_id}", "SELECT * FROM tbl_timers WHERE id = ?", (1,)),
+    (
+        "GET /timers/?order=start_time&after=",
+        *main.keyset_query(
+            "tbl_timers", main.TIMER_COLUMNS, "start_time", main.encode_page_token("start_time", ("2024-01-01", 1)), 100
+        ),
+    ),
+    ("GET /timers/active/", main.ACTIVE_TIMERS_QUERY, ()),
+    ("GET /timers/duration/", main.TOTAL_TIME_QUERY, ("task",)),
+    ("GET /timers/range/", main.TIMERS_IN_RANGE_QUERY, {"start": "2024-01-01", "end": "2024-02-01"}),
+    ("GET /timers/range/?format=ndjson (parts)", main.RANGE_PARTS_QUERY, {"start": "2024-01-01", "end": "2024-02-01", "part": 0}),
+    (
+        "GET /timers/range/?format=ndjson (timers)",
+        *main.keyset_query(
+            "tbl_timers", main.TIMER_COLUMNS, "start_time", None, 500,
+            "start_time BETWEEN ? AND ?", ("2024-01-01", "2024-02-01"), ("2024-01-01", 1),
+        ),
+    ),
+    ("GET /timers/daily/?task_name=", main.DAILY_STATS_QUERY, ("task", "2024-01-01", "2024-02-01")),
+    ("GET /timers/daily/", main.ALL_TASKS_DAILY_STATS_QUERY, ("2024-01-01", "2024-02-01")),
+    ("GET /timers/stats/?bucket=day&by_task=true", main.timer_stats_query("day", True)[0], ("2024-01-01", "2024-02-01")),
+    (
+        "GET /timers/stats/?task_name=",
+        main.timer_stats_query("week", False, "task")[0],
+        ("2024-01-01", "2024-02-01", "task"),
+    ),
+    ("GET /timers/stats/?bucket=week (whole days)", main.rollup_stats_query("week")[0], ("2024-01-01", "2024-02-01")),
+    (
+        "GET /timers/stats/?task_name= (whole days)",
+        main.rollup_stats_query(None, False, "task")[0],
+        ("2024-01-01", "2024-02-01", "task"),
+    ),
+    ("GET /sync", main.SYNC_QUERY, (0, 100)),
+    ("POST /notes/bulk (idempotency keys)", main.IDEMPOTENCY_KEYS_QUERY, ("tbl_notes", '["a", "b"]')),
+    chunk_check(
+        "DELETE /notes/bulk-delete/", "tbl_notes",
+        main.note_filter(main.NoteFilter(title="note", updated_start="2024-01-01T00:00:00")),
+    ),
+    chunk_check("DELETE /timers/bulk-delete/", "tbl_timers", main.timer_filter(main.TimerFilter(task_name="task"))),
+    ("GET /jobs/{id}", JOB_QUERY, ("job",)),
+    ("bulk jobs (dropping old ones)", PRUNE_JOBS_QUERY, (100,)),
+]
+
+
+def table_scans(db, query, params):
+    # A bare "SCAN <table>" means a full table scan. "SCAN ... USING INDEX"
+    # walks an index in order and stops at the LIMIT, and FTS5 lookups show
+    # up as "SCAN ... VIRTUAL TABLE INDEX"; both are fine. So are scans of
+    # CTEs and subqueries, which only see the rows their own steps found.
+    plan = [row[3] for row in db.execute("EXPLAIN QUERY PLAN " + query, params)]
+    derived = {step.split(" ", 1)[1] for step in plan if step.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+    return plan, [
+        step for step in plan
+        if step.startswith("SCAN ") and " USING " not in step and " VIRTUAL TABLE " not in step
+        and step[len("SCAN "):] not in derived
+    ]
+
+
+def check_plans(args):
+    db = sqlite3.connect(":memory:")
+    migrate(db)
+    failures = 0
+    for endpoint, query, params in PLAN_CHECKS:
+        plan, scans = table_scans(db, query, params)
+        status = "FAIL" if scans else "ok"
+        failures += bool(scans)
+        print(f"{status:4} {endpoint}: {'; '.join(plan)}")
+    db.close()
+    return 1 if failures else 0
+
+
+def timer_stats_differences(db):
+    # Recompute every aggregate from tbl_timers and the archived share into
+    # temp tables and diff them against the maintained ones in both
+    # directions.
+    differences = {}
+    for table in TIMER_STATS_TABLES:
+        db.execute(f"DROP TABLE IF EXISTS temp.{table}")
+        db.execute(f"CREATE TEMP TABLE {table} AS SELECT * FROM main.{table} LIMIT 0")
+    for statement in rebuild_timer_stats_statements("temp", archived=True):
+        db.execute(statement)
+    for table in TIMER_STATS_TABLES:
+        missing = db.execute(f"SELECT * FROM temp.{table} EXCEPT SELECT * FROM main.{table}").fetchall()
+        extra = db.execute(f"SELECT * FROM main.{table} EXCEPT SELECT * FROM temp.{table}").fetchall()
+        if missing or extra:
+            differences[table] = {"expected": missing, "stored": extra}
+        db.execute(f"DROP TABLE temp.{table}")
+    return differences
+
+
+def verify_stats(args):
+    db = sqlite3.connect(args.database)
+    differences = timer_stats_differences(db)
+    db.close()
+    for table, rows in differences.items():
+        print(f"{table}: {len(rows['expected'])} expected rows missing, {len(rows['stored'])} stored rows wrong")
+        for row in rows["expected"][:10]:
+            print(f"  expected {row}")
+        for row in rows["stored"][:10]:
+            print(f"  stored   {row}")
+    if not differences:
+        print("Timer aggregates match a full recompute")
+    return 1 if differences else 0
+
+
+def rebuild_stats(args):
+    db = sqlite3.connect(args.database)
+    db.execute("BEGIN IMMEDIATE")
+    for statement in rebuild_timer_stats_statements(archived=True):
+        db.execute(statement)
+    db.commit()
+    db.close()
+    print("Timer aggregates rebuilt")
+    return 0
+
+
+def archive_timers(args):
+    # What the server does in the background when retention is set, run
+    # once by hand. Safe while the server is up: each chunk is its own
+    # IMMEDIATE transaction.
+    if args.months <= 0:
+        print("Set --months or MEMOTIME_TIMER_RETENTION_MONTHS to a positive number of months")
+        return 1
+    archive = TimerArchive(args.archive_dir, args.months)
+    cutoff = retention_cutoff(args.months)
+    db = sqlite3.connect(args.database)
+    moved = 0
+    while True:
+        written = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            count = archive.archive_chunk(db, cutoff, written)
+            db.commit()
+        except Exception:
+            db.rollback()
+            for path in written:
+                os.remove(path)
+            raise
+        if not count:
+            break
+        moved += count
+    db.close()
+    print(f"Moved {moved} timers that started before {cutoff} to {os.path.abspath(archive.directory)}")
+    return 0
+
+
+COMMANDS = {
+    "archive-timers": archive_timers,
+    "check-plans": check_plans,
+    "rebuild-stats": rebuild_stats,
+    "verify-stats": verify_stats,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance commands for the memotime database")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("--database", default=DB_PATH)
+    parser.add_argument("--months", type=int, default=TIMER_RETENTION_MONTHS, help="archive-timers: months kept in tbl_timers")
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    args = parser.parse_args()
+    sys.exit(COMMANDS[args.command](args))
@@ -0,0 +1,234 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+# The first table a statement reads or writes
+STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+([\w.]+)", re.IGNORECASE)
+
+# Sampling profiler for slow requests; off unless MEMOTIME_PROFILE is set or
+# it is switched on through POST /metrics/profiler/
+PROFILE_ENABLED = os.environ.get("MEMOTIME_PROFILE", "") not in ("", "0")
+PROFILE_INTERVAL = float(os.environ.get("MEMOTIME_PROFILE_INTERVAL", 0.005))
+PROFILE_SLOW_SECONDS = float(os.environ.get("MEMOTIME_PROFILE_SLOW_MS", 500)) / 1000
+# fastapi_app/profiles unless set, whatever directory the server is started from
+PROFILE_DIR = os.environ.get("MEMOTIME_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+# Samples kept for requests still in flight; older ones are dropped
+PROFILE_MAX_SAMPLES = 100_000
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+
+
+# Histograms by name and label values, rendered in the
+# Prometheus text exposition format. Observations come from the event loop
+# and the database threads, so every update takes the lock.
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = {}
+
+    def observe(self, name, help, labels, values, value, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = {"help": help, "labels": labels, "buckets": buckets, "series": {}}
+            series = family["series"]
+            histogram = series.get(values)
+            if histogram is None:
+                histogram = series[values] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self, gauges=()):
+        # gauges are (name, help, value) read at scrape time
+        lines = []
+        with self._lock:
+            for name, family in sorted(self._families.items()):
+                lines.append(f"# HELP {name} {family['help']}")
+                lines.append(f"# TYPE {name} histogram")
+                for values, series in sorted(family["series"].items()):
+                    labels = _labels(family["labels"], values)
+                    braced = f"{{{labels}}}" if labels else ""
+                    cumulative = 0
+                    for bound, count in zip((*family["buckets"], "+Inf"), series.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+                    lines.append(f"{name}_sum{braced} {series.sum}")
+                    lines.append(f"{name}_count{braced} {cumulative}")
+        for name, help, value in gauges:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(names, values):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def statement_label(query):
+    # The statement's first word and the first table it names, such as
+    # "SELECT tbl_notes": short, and one series however many projections,
+    # filters and pages a query is built with. Write functions are observed
+    # by name and keep it.
+    words = query.split()
+    table = STATEMENT_TABLE.search(query)
+    return f"{words[0]} {table.group(1)}" if words and table else " ".join(words[:1])
+
+
+# Samples every thread's stack while requests are in flight. When a request
+# takes longer than slow_seconds, the samples taken during it are written
+# to PROFILE_DIR in the folded format flamegraph.pl and speedscope read:
+# one "frame;frame;frame count" line per distinct stack. Concurrent requests
+# share the event loop and database threads, so a dump can include their
+# work too.
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL, slow_seconds=PROFILE_SLOW_SECONDS, directory=PROFILE_DIR):
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.directory = directory
+        self.enabled = False
+        self.dumps = 0
+        self._samples = deque(maxlen=PROFILE_MAX_SAMPLES)
+        self._active = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enable(self, slow_seconds=None):
+        if slow_seconds is not None:
+            self.slow_seconds = slow_seconds
+        with self._lock:
+            self.enabled = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._thread.start()
+
+    def disable(self):
+        with self._lock:
+            self.enabled = False
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        self._samples.clear()
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "interval_ms": self.interval * 1000,
+            "slow_ms": self.slow_seconds * 1000,
+            "directory": os.path.abspath(self.directory),
+            "dumps": self.dumps,
+        }
+
+    def begin(self):
+        with self._lock:
+            self._active += 1
+        return time.monotonic()
+
+    def end(self, started, name):
+        finished = time.monotonic()
+        with self._lock:
+            self._active -= 1
+            idle = not self._active
+        if finished - started >= self.slow_seconds:
+            stacks = {}
+            for taken, stack in list(self._samples):
+                if started <= taken <= finished:
+                    stacks[stack] = stacks.get(stack, 0) + 1
+            if stacks:
+                self._dump(name, finished - started, stacks)
+        if idle:
+            self._samples.clear()
+
+    def _dump(self, name, seconds, stacks):
+        os.makedirs(self.directory, exist_ok=True)
+        safe = "".join(char if char.isalnum() else "_" for char in name).strip("_")
+        path = os.path.join(self.directory, f"{time.strftime('%Y%m%dT%H%M%S')}-{int(seconds * 1000)}ms-{safe}.folded")
+        with open(path, "w") as file:
+            file.writelines(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+        self.dumps += 1
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while self.enabled:
+            time.sleep(self.interval)
+            if not self._active:
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            taken = time.monotonic()
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._samples.append((taken, _fold(names.get(ident, str(ident)), frame)))
+
+
+def _fold(thread_name, frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ";".join(reversed(frames))
+
+
+# ASGI middleware recording latency and response size per route. It wraps
+# `send` rather than the response, so streaming bodies pass straight through.
+# The route template is read from the scope once routing has filled it in.
+class RequestMetrics:
+    def __init__(self, app, metrics, profiler):
+        self.app = app
+        self.metrics = metrics
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        profiling = self.profiler.begin() if self.profiler.enabled else None
+        status = 500
+        size = 0
+
+        async def send_counted(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_counted)
+        finally:
+            route = scope.get("route")
+            values = (scope["method"], route.path if route is not None else "unmatched")
+            self.metrics.observe(
+                "memotime_request_duration_seconds", "Time from request start to the last body byte",
+                ("method", "route", "status"), values + (str(status),), time.perf_counter() - started,
+            )
+            self.metrics.observe(
+                "memotime_response_bytes", "Response body size as sent, after compression",
+                ("method", "route"), values, size, SIZE_BUCKETS,
+            )
+            if profiling is not None:
+                self.profiler.end(profiling, " ".join(values))
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from array import array
+from datetime import datetime, timezone
+
+# Rows a bulk update or delete changes per write. Every chunk is a write of
+# its own, so writes queued meanwhile get the lock before the next chunk.
+MUTATION_CHUNK_SIZE = int(os.environ.get("MEMOTIME_MUTATION_CHUNK_SIZE", 1000))
+# Finished jobs still reported by GET /jobs/, the oldest dropped first
+MUTATION_JOBS_KEPT = 100
+
+JOB_COLUMNS = (
+    "id", "kind", "state", "candidates", "processed", "changed", "chunks",
+    "started_at", "seconds", "finished_at", "error",
+)
+JOB_QUERY = f"SELECT {', '.join(JOB_COLUMNS)} FROM tbl_jobs WHERE id = ?"
+JOBS_QUERY = f"SELECT {', '.join(JOB_COLUMNS)} FROM tbl_jobs ORDER BY rowid DESC"
+PRUNE_JOBS_QUERY = """
+    DELETE FROM tbl_jobs WHERE id IN (
+        SELECT id FROM tbl_jobs WHERE finished_at IS NOT NULL ORDER BY finished_at DESC LIMIT -1 OFFSET ?
+    )
+"""
+
+CHUNK_IDS = "SELECT value FROM json_each(:ids)"
+# :first and :last bound the ids a chunk covers, for conditions such as an
+# FTS match that are cheaper over a rowid range than over the whole table
+FIRST_ID, LAST_ID = -(2 ** 63), 2 ** 63 - 1
+
+
+# One bulk update or delete. `statement` changes the rows whose ids are in
+# :ids; `where` is the request's filter over `table`. Rows are matched
+# twice: once up front, in a read, for the candidate ids, and again in each
+# chunk's write, so a row changed since then to no longer match is left
+# alone. Explicit ids skip the read and are the candidates themselves.
+# Rows that come to match after the read are not picked up.
+class BulkMutation:
+    def __init__(self, kind, table, statement, where="1", params=None, ids=None, on_chunk=None):
+        self.kind = kind
+        self.statement = statement
+        self.params = params or {}
+        self.ids = array("q", sorted(set(ids))) if ids is not None else None
+        self.on_chunk = on_chunk
+        self.resolve_query = f"SELECT id FROM {table} WHERE {where} ORDER BY id"
+        # The chunk's rows are looked up by id first, so the filter never
+        # walks an index over every row it matches
+        self.match_query = f"""
+            WITH chunk AS MATERIALIZED (SELECT * FROM {table} WHERE id IN ({CHUNK_IDS}))
+            SELECT id FROM chunk WHERE {where}
+        """
+
+    def resolve(self, db):
+        # A read function: ids of every row the filter matches now
+        params = {**self.params, "first": FIRST_ID, "last": LAST_ID}
+        return array("q", (row[0] for row in db.execute(self.resolve_query, params)))
+
+    def apply(self, db, candidates):
+        # A write function: changes the candidates, in id order, that still
+        # match and returns their ids
+        params = {**self.params, "ids": json.dumps(candidates), "first": candidates[0], "last": candidates[-1]}
+        ids = [row[0] for row in db.execute(self.match_query, params)]
+        if ids:
+            db.execute(self.statement, {**self.params, "ids": json.dumps(ids)})
+        return ids
+
+
+# Runs bulk mutations chunk by chunk, in the request or as background tasks.
+# Jobs are rows of tbl_jobs, so GET /jobs/ and DELETE /jobs/{id} work from
+# any worker; the worker running a job records each chunk in the same write
+# as the chunk itself, and checks there whether the job is being cancelled.
+# A job whose worker exits without finishing it stays "running".
+class MutationJobs:
+    def __init__(self, chunk_size=MUTATION_CHUNK_SIZE, kept=MUTATION_JOBS_KEPT):
+        self.chunk_size = chunk_size
+        self.kept = kept
+        self._tasks = {}
+
+    def _create(self, db, mutation):
+        # A write function: adds the job and drops the oldest finished ones
+        job = dict.fromkeys(JOB_COLUMNS)
+        job.update(
+            id=uuid.uuid4().hex, kind=mutation.kind, state="pending", processed=0, changed=0, chunks=0,
+            started_at=datetime.now(timezone.utc).isoformat(),
+        )
+        db.execute(f"INSERT INTO tbl_jobs VALUES ({', '.join('?' * len(JOB_COLUMNS))})", tuple(job.values()))
+        db.execute(PRUNE_JOBS_QUERY, (self.kept,))
+        return job
+
+    async def run(self, database, mutation):
+        # In the caller's task; returns the finished job or raises its error
+        job = await database.write(self._create, mutation)
+        return await self._run(database, mutation, job["id"])
+
+    async def start(self, database, mutation):
+        job = await database.write(self._create, mutation)
+        self._tasks[job["id"]] = asyncio.create_task(self._run_in_background(database, mutation, job["id"]))
+        return job
+
+    async def _run_in_background(self, database, mutation, job_id):
+        try:
+            await self._run(database, mutation, job_id)
+        except Exception:
+            pass  # recorded on the job
+        finally:
+            self._tasks.pop(job_id, None)
+
+    async def _run(self, database, mutation, job_id):
+        started = time.perf_counter()
+        state, error = "done", None
+        try:
+            candidates = mutation.ids if mutation.ids is not None else await database.read(mutation.resolve)
+            if not await database.write(_begin, job_id, len(candidates)):
+                state = "cancelled"
+            for start in range(0, len(candidates), self.chunk_size):
+                if state == "cancelled":
+                    break
+                chunk = candidates[start:start + self.chunk_size].tolist()
+                ids = await database.write(_apply_chunk, mutation, job_id, chunk)
+                if ids is None:
+                    state = "cancelled"
+                elif ids and mutation.on_chunk is not None:
+                    mutation.on_chunk(ids)
+        except asyncio.CancelledError:
+            state = "cancelled"
+            raise
+        except Exception as e:
+            state, error = "failed", repr(e)
+            raise
+        finally:
+            job = await database.write(_finish, job_id, state, time.perf_counter() - started, error)
+        return job
+
+    async def get(self, database, job_id):
+        row = await database.fetchone(JOB_QUERY, (job_id,))
+        return dict(zip(JOB_COLUMNS, row)) if row is not None else None
+
+    async def all(self, database):
+        return [dict(zip(JOB_COLUMNS, row)) for row in await database.fetchall(JOBS_QUERY)]
+
+    async def cancel(self, database, job_id):
+        # Stops the job before its next chunk; chunks already written stay.
+        # Returns the job, False if it had already finished or None if there
+        # is no such job.
+        return await database.write(_cancel, job_id)
+
+    async def close(self, database):
+        # Stops this worker's background jobs at their next chunk boundary
+        for job_id in list(self._tasks):
+            await self.cancel(database, job_id)
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+def _job(db, job_id):
+    row = db.execute(JOB_QUERY, (job_id,)).fetchone()
+    return dict(zip(JOB_COLUMNS, row)) if row is not None else None
+
+
+def _begin(db, job_id, candidates):
+    # A write function: marks the job running unless it is being cancelled
+    cursor = db.execute(
+        "UPDATE tbl_jobs SET state = 'running', candidates = ? WHERE id = ? AND state = 'pending'",
+        (candidates, job_id),
+    )
+    return cursor.rowcount > 0
+
+
+def _apply_chunk(db, mutation, job_id, chunk):
+    # A write function: applies one chunk and counts it on the job, or
+    # returns None without applying it if the job is being cancelled
+    state = db.execute("SELECT state FROM tbl_jobs WHERE id = ?", (job_id,)).fetchone()
+    if state is None or state[0] != "running":
+        return None
+    ids = mutation.apply(db, chunk)
+    db.execute(
+        "UPDATE tbl_jobs SET processed = processed + ?, changed = changed + ?, chunks = chunks + 1 WHERE id = ?",
+        (len(chunk), len(ids), job_id),
+    )
+    return ids
+
+
+def _finish(db, job_id, state, seconds, error):
+    db.execute(
+        "UPDATE tbl_jobs SET state = ?, seconds = ?, finished_at = ?, error = ? WHERE id = ?",
+        (state, seconds, datetime.now(timezone.utc).isoformat(), error, job_id),
+    )
+    return _job(db, job_id)
+
+
+def _cancel(db, job_id):
+    job = _job(db, job_id)
+    if job is None:
+        return None
+    if job["finished_at"] is not None:
+        return False
+    db.execute("UPDATE tbl_jobs SET state = 'cancelling' WHERE id = ?", (job_id,))
+    return _job(db, job_id)
@@ -0,0 +1,79 @@
+import os
+import random
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+# main reads MEMOTIME_DB_PATH on import; the API test runs on a scratch copy
+os.environ.setdefault("MEMOTIME_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="memotime-test-"), "memotime.db"))
+
+from fastapi.testclient import TestClient
+
+import main
+import manage
+from archive import TimerArchive
+from database import migrate
+
+
+def test_every_checked_query_uses_an_index():
+    assert manage.check_plans(None) == 0
+
+
+def test_timer_stats_follow_insert_update_archive_and_delete(tmp_path):
+    db = sqlite3.connect(tmp_path / "memotime.db")
+    migrate(db)
+    rng = random.Random(0)
+    # From July 2023 to June 2024; the archive takes the half before 2024
+    for _ in range(500):
+        start = datetime(2023, 7, 1) + timedelta(minutes=rng.randrange(366 * 24 * 60))
+        end = None if rng.random() < 0.05 else start + timedelta(seconds=rng.randrange(60, 7200))
+        db.execute(
+            "INSERT INTO tbl_timers (task_name, start_time, end_time, duration) VALUES (?, ?, ?, ?)",
+            (
+                rng.choice(("a", "b", "c")), str(start), end and str(end),
+                end and int((end - start).total_seconds()),
+            ),
+        )
+    db.commit()
+    db.execute("UPDATE tbl_timers SET task_name = 'd' WHERE id % 7 = 0")
+    db.execute(
+        "UPDATE tbl_timers SET end_time = datetime(end_time, '+60 seconds'), duration = duration + 60 WHERE id % 5 = 0"
+    )
+    # Stops half the running timers
+    db.execute(
+        "UPDATE tbl_timers SET end_time = datetime(start_time, '+30 minutes'), duration = 1800"
+        " WHERE end_time IS NULL AND id % 2 = 0"
+    )
+    db.commit()
+    archive = TimerArchive(str(tmp_path / "archive"), 6, chunk_size=50)
+    while True:
+        db.execute("BEGIN IMMEDIATE")
+        count = archive.archive_chunk(db, "2024-01-01", [])
+        db.commit()
+        if not count:
+            break
+    db.execute("DELETE FROM tbl_timers WHERE id % 3 = 0")
+    db.commit()
+    assert db.execute("SELECT COUNT(*) FROM tbl_timer_archive").fetchone()[0] > 0
+    assert manage.timer_stats_differences(db) == {}
+    db.close()
+
+
+def test_timer_range_compares_offsets_in_utc():
+    with TestClient(main.app) as client:
+        client.post(
+            "/timers/",
+            json={"task_name": "utc", "start_time": "2024-01-01T08:00:00Z", "end_time": "2024-01-01T09:00:00Z"},
+        )
+        for format in ("json", "ndjson"):
+            # 00:00 to 07:00 UTC, then to 08:00 UTC
+            before = client.get(
+                "/timers/range/",
+                params={"start": "2024-01-01T00:00:00+02:00", "end": "2024-01-01T09:00:00+02:00", "format": format},
+            )
+            through = client.get(
+                "/timers/range/",
+                params={"start": "2024-01-01T00:00:00+02:00", "end": "2024-01-01T10:00:00+02:00", "format": format},
+            )
+            assert "utc" not in before.text
+            assert "2024-01-01 08:00:00" in through.text
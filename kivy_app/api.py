@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from kivy.clock import Clock
+
+TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+# Connection attempts are retried by the transport; requests that reached
+# the server are not. The replica resends unanswered bulk creates itself,
+# with the same idempotency keys, so they are still only made once.
+CONNECT_RETRIES = 2
+WORKERS = 4
+# Changes fetched per GET /sync request
+SYNC_PAGE_SIZE = 1000
+# The server sends a keep-alive at least every 15 seconds, so a read that
+# takes longer than this means the event stream is dead
+EVENTS_TIMEOUT = httpx.Timeout(10.0, read=45.0)
+# Pause before reconnecting after the event stream fails
+EVENTS_RETRY_DELAY = 5.0
+
+
+# Talks to the API off the Kivy main thread. One keep-alive httpx client is
+# shared by a few worker threads; results are handed back to the UI thread
+# with Clock so callbacks can touch widgets safely.
+class ApiClient:
+    def __init__(self, base_url, workers=WORKERS):
+        self.base_url = base_url
+        self.closed = False
+        self.client = httpx.Client(
+            base_url=base_url,
+            timeout=TIMEOUT,
+            transport=httpx.HTTPTransport(retries=CONNECT_RETRIES),
+            limits=httpx.Limits(max_connections=workers, max_keepalive_connections=workers),
+        )
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api")
+
+    def submit(self, fn, *args, on_success=None, on_error=None):
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda done: Clock.schedule_once(lambda dt: self._deliver(done, on_success, on_error)))
+        return future
+
+    def _deliver(self, future, on_success, on_error):
+        try:
+            result = future.result()
+        except Exception as e:
+            if on_error:
+                on_error(e)
+            return
+        if on_success:
+            on_success(result)
+
+    def close(self):
+        self.closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.client.close()
+
+    def listen(self, since, on_change):
+        # Follows GET /events on a thread and connection of its own, so the
+        # long-lived stream never holds up the workers. on_change gets each
+        # change as GET /sync would return it, on the listener thread.
+        thread = threading.Thread(target=self._listen, args=(since, on_change), name="api-events", daemon=True)
+        thread.start()
+        return thread
+
+    def _listen(self, since, on_change):
+        with httpx.Client(base_url=self.base_url, timeout=EVENTS_TIMEOUT) as client:
+            while not self.closed:
+                try:
+                    # The server ends streams every so often; resuming from
+                    # the last seq seen loses nothing
+                    with client.stream("GET", "/events", params={"since": since()}) as response:
+                        response.raise_for_status()
+                        for line in response.iter_lines():
+                            if line.startswith("data:"):
+                                on_change(json.loads(line[5:]))
+                except (httpx.HTTPError, ValueError):
+                    time.sleep(EVENTS_RETRY_DELAY)
+
+    # Blocking calls below run on the worker threads
+
+    def get_changes(self, since, limit=SYNC_PAGE_SIZE):
+        response = self.client.get("/sync", params={"since": since, "limit": limit})
+        response.raise_for_status()
+        return response.json()
+
+    def get_note(self, note_id):
+        response = self.client.get(f"/notes/{note_id}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    def create_many(self, entity, items):
+        # Bulk endpoints report the ids of the accepted items in order, plus
+        # the index of every item they rejected or want resent
+        response = self.client.post(f"/{entity}s/bulk", json=items)
+        response.raise_for_status()
+        return response.json()
+
+    def update(self, entity, entity_id, item):
+        self.client.put(f"/{entity}s/{entity_id}", json=item).raise_for_status()
+
+    def stop_timer(self, timer_id, end_time):
+        self.client.post(f"/timers/{timer_id}/stop", json={"end_time": end_time}).raise_for_status()
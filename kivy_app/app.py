@@ -4,11 +4,100 @@ from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
-from kivy.uix.scrollview import ScrollView
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.properties import ObjectProperty
 from kivy.clock import Clock
-import httpx
+from datetime import datetime, timezone
+
+from api import ApiClient
+from replica import Replica
 
 API_BASE_URL = "http://127.0.0.1:8000"
+# Seconds between background syncs with the server
+SYNC_INTERVAL = 30
+
+api = ApiClient(API_BASE_URL)
+replica = Replica()
+
+PAGE_SIZE = 50
+ROW_HEIGHT = 100
+# Fetch the next page once the list is scrolled this close to the bottom
+LOAD_MORE_AT = 0.1
+
+
+class NoteRow(Button):
+    note = ObjectProperty(None, allownone=True)
+    select = ObjectProperty(None, allownone=True)
+
+    def on_press(self):
+        if self.select:
+            self.select(self.note)
+
+
+class TimerRow(Button):
+    timer = ObjectProperty(None, allownone=True)
+    select = ObjectProperty(None, allownone=True)
+
+    def on_press(self):
+        if self.select:
+            self.select(self.timer)
+
+
+def utc_now():
+    # Naive UTC, the same as the server's timestamps
+    return datetime.now(timezone.utc).replace(tzinfo=None).isoformat(sep=" ", timespec="seconds")
+
+
+# Virtualized list over one replica table. RecycleView only creates widgets
+# for the visible rows and reuses them while scrolling. Further pages are
+# read as the user nears the bottom, and a refresh rereads the rows already
+# shown and patches just the ones that changed.
+class PagedList(RecycleView):
+    def __init__(self, entity, viewclass, to_row, **kwargs):
+        super().__init__(**kwargs)
+        self.entity = entity
+        self.viewclass = viewclass
+        self.to_row = to_row
+        self.next_page = None
+
+        layout = RecycleBoxLayout(
+            orientation='vertical',
+            default_size=(None, ROW_HEIGHT),
+            default_size_hint=(1, None),
+            size_hint_y=None
+        )
+        layout.bind(minimum_height=layout.setter('height'))
+        self.add_widget(layout)
+        self.bind(scroll_y=self.check_scroll)
+
+    def refresh(self, *args):
+        items, self.next_page = replica.page(self.entity, None, max(len(self.data), PAGE_SIZE))
+        self.patch([self.to_row(item) for item in items])
+
+    def load_more(self):
+        if self.next_page is None:
+            return
+        items, self.next_page = replica.page(self.entity, self.next_page, PAGE_SIZE)
+        self.data.extend(self.to_row(item) for item in items)
+
+    def check_scroll(self, instance, scroll_y):
+        # scroll_y goes from 1 at the top to 0 at the bottom
+        if scroll_y <= LOAD_MORE_AT:
+            self.load_more()
+
+    def patch(self, rows):
+        # Only touched entries are re-rendered, so an unchanged refresh costs
+        # nothing and an edit updates a single visible row
+        data = self.data
+        for index, row in enumerate(rows[:len(data)]):
+            if data[index] != row:
+                data[index] = row
+        if len(rows) > len(data):
+            data.extend(rows[len(data):])
+        elif len(rows) < len(data):
+            del data[len(rows):]
+
 
 class HomeScreen(Screen):
     def __init__(self, **kwargs):
@@ -50,13 +139,11 @@ class NotesScreen(Screen):
         back_button.bind(on_press=self.go_back)
         self.layout.add_widget(back_button)
 
-        self.scrollview = ScrollView(size_hint=(1, None), size=(self.width, 400))
-        self.notes_list = BoxLayout(orientation='vertical', size_hint_y=None)
-        self.notes_list.bind(minimum_height=self.notes_list.setter('height'))
-        self.scrollview.add_widget(self.notes_list)
+        self.notes_list = PagedList("note", NoteRow, self.note_row, size_hint=(1, None), height=400)
+        self.status_label = Label(text="", size_hint_y=None, height=50)
 
         self.refresh_button = Button(text="Refresh Notes")
-        self.refresh_button.bind(on_press=lambda x: Clock.schedule_once(self.refresh_notes))
+        self.refresh_button.bind(on_press=lambda x: App.get_running_app().sync())
         self.layout.add_widget(self.refresh_button)
 
         self.title_input = TextInput(hint_text="Title")
@@ -72,62 +159,55 @@ class NotesScreen(Screen):
         update_note_button.bind(on_press=lambda x: Clock.schedule_once(self.update_note))
         self.layout.add_widget(update_note_button)
 
-        self.layout.add_widget(self.scrollview)
+        self.layout.add_widget(self.status_label)
+        self.layout.add_widget(self.notes_list)
         self.add_widget(self.layout)
 
         Clock.schedule_once(self.refresh_notes)
 
     def refresh_notes(self, *args):
-        self.notes_list.clear_widgets()
-        try:
-            response = httpx.get(f"{API_BASE_URL}/notes/")
-            if response.status_code == 200:
-                notes = response.json()
-                for note in notes:
-                    note_button = Button(
-                        text=f"{note['id']}: {note['title']}\n{note['content']}",
-                        size_hint_y=None,
-                        height=100
-                    )
-                    note_button.bind(on_press=lambda btn, note=note: self.select_note(note))
-                    self.notes_list.add_widget(note_button)
-        except httpx.RequestError as e:
-            self.notes_list.add_widget(Label(text=f"Error: {e}", size_hint_y=None, height=50))
+        self.notes_list.refresh()
+
+    def note_row(self, note):
+        # A one-line preview; the full text is loaded when the note is selected
+        preview = note['content'].partition("\n")[0]
+        return {
+            "text": f"{note['id']}: {note['title']}\n{preview}",
+            "note": note,
+            "select": self.select_note,
+        }
+
+    def show_status(self, text):
+        self.status_label.text = text
 
     def add_note(self, *args):
         title = self.title_input.text
         content = self.content_input.text
-        try:
-            response = httpx.post(f"{API_BASE_URL}/notes/", json={"title": title, "content": content})
-            if response.status_code == 201:
-                self.title_input.text = ""
-                self.content_input.text = ""
-                self.selected_note_id = None  # Clear selected note
-                Clock.schedule_once(self.refresh_notes)
-        except httpx.RequestError as e:
-            self.notes_list.add_widget(Label(text=f"Error: {e}", size_hint_y=None, height=50))
+        replica.add_note(title, content)
+        self.note_saved()
+
+    def note_saved(self):
+        self.title_input.text = ""
+        self.content_input.text = ""
+        self.selected_note_id = None  # Clear selected note
+        self.refresh_notes()
+        App.get_running_app().sync()
 
     def update_note(self, *args):
         if not self.selected_note_id:
-            self.notes_list.add_widget(Label(text="Select a note to update first.", size_hint_y=None, height=50))
+            self.status_label.text = "Select a note to update first."
             return
 
         title = self.title_input.text
         content = self.content_input.text
-        try:
-            response = httpx.put(
-                f"{API_BASE_URL}/notes/{self.selected_note_id}/",
-                json={"title": title, "content": content}
-            )
-            if response.status_code == 200:
-                self.title_input.text = ""
-                self.content_input.text = ""
-                self.selected_note_id = None  # Clear selected note
-                Clock.schedule_once(self.refresh_notes)
-        except httpx.RequestError as e:
-            self.notes_list.add_widget(Label(text=f"Error: {e}", size_hint_y=None, height=50))
+        if not replica.update_note(self.selected_note_id, title, content):
+            self.status_label.text = "That note has changed, select it again."
+            self.refresh_notes()
+            return
+        self.note_saved()
 
     def select_note(self, note):
+        note = replica.get("note", note['id']) or note
         self.selected_note_id = note['id']
         self.title_input.text = note['title']
         self.content_input.text = note['content']
@@ -140,19 +220,18 @@ class NotesScreen(Screen):
 class TimerScreen(Screen):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.selected_timer_id = None  # The running timer Stop Timer applies to
         self.layout = BoxLayout(orientation='vertical')
 
         back_button = Button(text="Back to Home")
         back_button.bind(on_press=self.go_back)
         self.layout.add_widget(back_button)
 
-        self.scrollview = ScrollView(size_hint=(1, None), size=(self.width, 400))
-        self.timers_list = BoxLayout(orientation='vertical', size_hint_y=None)
-        self.timers_list.bind(minimum_height=self.timers_list.setter('height'))
-        self.scrollview.add_widget(self.timers_list)
+        self.timers_list = PagedList("timer", TimerRow, self.timer_row, size_hint=(1, None), height=400)
+        self.status_label = Label(text="", size_hint_y=None, height=50)
 
         self.refresh_button = Button(text="Refresh Timers")
-        self.refresh_button.bind(on_press=lambda x: Clock.schedule_once(self.refresh_timers))
+        self.refresh_button.bind(on_press=lambda x: App.get_running_app().sync())
         self.layout.add_widget(self.refresh_button)
 
         self.task_name_input = TextInput(hint_text="Task Name")
@@ -166,40 +245,76 @@ class TimerScreen(Screen):
         add_timer_button.bind(on_press=lambda x: Clock.schedule_once(self.add_timer))
         self.layout.add_widget(add_timer_button)
 
-        self.layout.add_widget(self.scrollview)
+        start_timer_button = Button(text="Start Timer")
+        start_timer_button.bind(on_press=lambda x: Clock.schedule_once(self.start_timer))
+        self.layout.add_widget(start_timer_button)
+
+        stop_timer_button = Button(text="Stop Timer")
+        stop_timer_button.bind(on_press=lambda x: Clock.schedule_once(self.stop_timer))
+        self.layout.add_widget(stop_timer_button)
+
+        self.layout.add_widget(self.status_label)
+        self.layout.add_widget(self.timers_list)
         self.add_widget(self.layout)
 
         Clock.schedule_once(self.refresh_timers)
 
     def refresh_timers(self, *args):
-        self.timers_list.clear_widgets()
-        try:
-            response = httpx.get(f"{API_BASE_URL}/timers/")
-            if response.status_code == 200:
-                timers = response.json()
-                for timer in timers:
-                    timer_label = Label(
-                        text=f"{timer['id']}: {timer['task_name']}\n{timer['start_time']} - {timer['end_time']}\nDuration: {timer['duration']}",
-                        size_hint_y=None,
-                        height=100
-                    )
-                    self.timers_list.add_widget(timer_label)
-        except httpx.RequestError as e:
-            self.timers_list.add_widget(Label(text=f"Error: {e}", size_hint_y=None, height=50))
+        self.timers_list.refresh()
+
+    def timer_row(self, timer):
+        if timer['end_time'] is None:
+            text = f"{timer['id']}: {timer['task_name']}\n{timer['start_time']} - running"
+        else:
+            text = f"{timer['id']}: {timer['task_name']}\n{timer['start_time']} - {timer['end_time']}\nDuration: {timer['duration']}"
+        return {"text": text, "timer": timer, "select": self.select_timer}
+
+    def select_timer(self, timer):
+        self.selected_timer_id = timer['id']
+        self.task_name_input.text = timer['task_name']
+
+    def show_status(self, text):
+        self.status_label.text = text
 
     def add_timer(self, *args):
         task_name = self.task_name_input.text
         start_time = self.start_time_input.text
         end_time = self.end_time_input.text
+        # Checked here because a queued timer the server rejects is dropped
         try:
-            response = httpx.post(f"{API_BASE_URL}/timers/", json={"task_name": task_name, "start_time": start_time, "end_time": end_time})
-            if response.status_code == 201:
-                self.task_name_input.text = ""
-                self.start_time_input.text = ""
-                self.end_time_input.text = ""
-                Clock.schedule_once(self.refresh_timers)
-        except httpx.RequestError as e:
-            self.timers_list.add_widget(Label(text=f"Error: {e}", size_hint_y=None, height=50))
+            duration = int((datetime.fromisoformat(end_time) - datetime.fromisoformat(start_time)).total_seconds())
+        except ValueError as e:
+            self.status_label.text = f"Error: {e}"
+            return
+        replica.add_timer(task_name, start_time, end_time, duration)
+        self.timer_saved()
+
+    def start_timer(self, *args):
+        task_name = self.task_name_input.text
+        if not task_name:
+            self.status_label.text = "Enter a task name first."
+            return
+        # Queued like any other new timer, with no end time until stopped
+        replica.add_timer(task_name, utc_now(), None, None)
+        self.timer_saved()
+
+    def stop_timer(self, *args):
+        if not self.selected_timer_id:
+            self.status_label.text = "Select a running timer to stop first."
+            return
+        if not replica.stop_timer(self.selected_timer_id, utc_now()):
+            self.status_label.text = "That timer is not running."
+            self.refresh_timers()
+            return
+        self.selected_timer_id = None
+        self.timer_saved()
+
+    def timer_saved(self):
+        self.task_name_input.text = ""
+        self.start_time_input.text = ""
+        self.end_time_input.text = ""
+        self.refresh_timers()
+        App.get_running_app().sync()
     
     def go_back(self, *args):
         self.manager.current = 'home'
@@ -235,15 +350,22 @@ class SearchNoteScreen(Screen):
             self.result_label.text = "Please enter a valid note ID."
             return
 
-        try:
-            response = httpx.get(f"{API_BASE_URL}/notes/{note_id}/")
-            if response.status_code == 200:
-                note = response.json()
-                self.result_label.text = f"ID: {note['id']}\nTitle: {note['title']}\nContent: {note['content']}"
-            else:
-                self.result_label.text = "Note not found."
-        except httpx.RequestError as e:
-            self.result_label.text = f"Error: {e}"
+        note = replica.get("note", int(note_id))
+        if note:
+            self.show_note(note)
+            return
+        # Not synced yet; ask the server directly
+        self.result_label.text = "Searching..."
+        api.submit(api.get_note, note_id, on_success=self.show_note, on_error=self.show_error)
+
+    def show_note(self, note):
+        if note:
+            self.result_label.text = f"ID: {note['id']}\nTitle: {note['title']}\nContent: {note['content']}"
+        else:
+            self.result_label.text = "Note not found."
+
+    def show_error(self, error):
+        self.result_label.text = f"Error: {error}"
 
     def go_back(self, *args):
         self.manager.current = 'home'
@@ -252,12 +374,48 @@ class SearchNoteScreen(Screen):
 class NotesTimersApp(App):
     def build(self):
         sm = ScreenManager()
+        self.notes_screen = NotesScreen(name='notes')
+        self.timer_screen = TimerScreen(name='timers')
         sm.add_widget(HomeScreen(name='home'))
-        sm.add_widget(NotesScreen(name='notes'))
-        sm.add_widget(TimerScreen(name='timers'))
+        sm.add_widget(self.notes_screen)
+        sm.add_widget(self.timer_screen)
         sm.add_widget(SearchNoteScreen(name='search'))  # Add the SearchNoteScreen
         return sm
 
+    def on_start(self):
+        self.sync()
+        Clock.schedule_interval(self.sync, SYNC_INTERVAL)
+        # Changes made elsewhere arrive as they happen; the periodic sync
+        # still pushes the outbox and covers gaps while the stream is down
+        api.listen(replica.cursor, self.pushed)
+
+    def pushed(self, change):
+        # Runs on the listener thread
+        if replica.apply([change], change["seq"]):
+            Clock.schedule_once(lambda dt: self.synced(True))
+
+    def sync(self, *args):
+        # Pushes queued writes and pulls changes in the background; the
+        # screens keep showing the replica meanwhile
+        api.submit(replica.sync, api, on_success=self.synced, on_error=self.sync_failed)
+
+    def synced(self, changed):
+        if changed:
+            self.notes_screen.refresh_notes()
+            self.timer_screen.refresh_timers()
+        self.show_status("")
+
+    def sync_failed(self, error):
+        self.show_status(f"Offline, {replica.pending()} changes waiting to sync ({error})")
+
+    def show_status(self, text):
+        self.notes_screen.show_status(text)
+        self.timer_screen.show_status(text)
+
+    def on_stop(self):
+        api.close()
+        replica.close()
+
 
 if __name__ == "__main__":
     NotesTimersApp().run()
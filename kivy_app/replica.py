@@ -0,0 +1,350 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import takewhile
+
+import httpx
+
+# Beside app.py, whatever directory the app is started from
+REPLICA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memotime_replica.db")
+# Most queued writes pushed per request
+OUTBOX_BATCH_SIZE = 100
+
+NOTE_COLUMNS = ["id", "title", "content", "created_at", "updated_at"]
+TIMER_COLUMNS = ["id", "task_name", "start_time", "end_time", "duration"]
+TABLES = {
+    "note": ("notes", NOTE_COLUMNS),
+    "timer": ("timers", TIMER_COLUMNS),
+}
+# page() carries only this much of a note's content; get() reads all of it
+PREVIEW_CHARS = 80
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS notes (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMP,
+        updated_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS timers (
+        id INTEGER PRIMARY KEY,
+        task_name TEXT NOT NULL,
+        start_time TIMESTAMP NOT NULL,
+        end_time TIMESTAMP,
+        duration INTEGER
+    )
+    """,
+    # Writes waiting to reach the server, oldest first. A create keeps one
+    # idempotency key through every resend, so the server makes it once.
+    """
+    CREATE TABLE IF NOT EXISTS outbox (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        op TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        idempotency_key TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_outbox_entity ON outbox (entity, entity_id)",
+    # The latest pulled change of each row that had writes queued, applied
+    # once the last of those writes has gone out
+    """
+    CREATE TABLE IF NOT EXISTS deferred (
+        entity TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        change TEXT NOT NULL,
+        PRIMARY KEY (entity, entity_id)
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value)",
+]
+
+
+# Local SQLite copy of the server's notes and timers. Screens read from it
+# and queue writes into it, so neither waits on the network. Rows created
+# offline get negative ids until the server assigns real ones. sync() pushes
+# the outbox and then pulls the change log from GET /sync; changes to rows
+# with queued writes are held back until those writes have gone out.
+class Replica:
+    def __init__(self, path=REPLICA_PATH):
+        # Shared by the UI thread and the sync worker, one statement at a time
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN/COMMIT by hand since the connection is in autocommit mode
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    # Reads for the screens
+
+    def page(self, entity, after=None, limit=50):
+        # Keyset page ordered by id; returns the rows and the id to continue
+        # after, or None at the end. Note content is cut to a preview.
+        table, columns = TABLES[entity]
+        select = [f"substr(content, 1, {PREVIEW_CHARS})" if column == "content" else column for column in columns]
+        query = f"SELECT {', '.join(select)} FROM {table}"
+        params = []
+        if after is not None:
+            query += " WHERE id > ?"
+            params.append(after)
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit + 1)
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        items = [dict(zip(columns, row)) for row in rows[:limit]]
+        return items, items[-1]["id"] if len(rows) > limit else None
+
+    def get(self, entity, entity_id):
+        table, columns = TABLES[entity]
+        with self.lock:
+            row = self.db.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE id = ?", (entity_id,)).fetchone()
+        return dict(zip(columns, row)) if row else None
+
+    def pending(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    # Local writes; each lands in the replica and the outbox atomically
+
+    def _local_id(self, db, table):
+        return db.execute(f"SELECT MIN(COALESCE(MIN(id), 0), 0) - 1 FROM {table}").fetchone()[0]
+
+    def add_note(self, title, content):
+        with self.transaction() as db:
+            note_id = self._local_id(db, "notes")
+            db.execute(
+                "INSERT INTO notes (id, title, content, created_at, updated_at) "
+                "VALUES (?, ?, ?, datetime('now'), datetime('now'))",
+                (note_id, title, content),
+            )
+            self._queue(db, "note", "create", note_id, {"title": title, "content": content})
+        return note_id
+
+    def update_note(self, note_id, title, content):
+        with self.transaction() as db:
+            updated = db.execute(
+                "UPDATE notes SET title = ?, content = ?, updated_at = datetime('now') WHERE id = ?",
+                (title, content, note_id),
+            ).rowcount
+            if not updated:
+                # Deleted by a pull, or a placeholder id that has since been
+                # swapped for the server's
+                return False
+            # A note that has not reached the server yet is still created in
+            # one step, with its latest text
+            op = "create" if note_id < 0 else "update"
+            self._queue(db, "note", op, note_id, {"title": title, "content": content})
+        return True
+
+    def add_timer(self, task_name, start_time, end_time, duration):
+        with self.transaction() as db:
+            timer_id = self._local_id(db, "timers")
+            db.execute(
+                "INSERT INTO timers (id, task_name, start_time, end_time, duration) VALUES (?, ?, ?, ?, ?)",
+                (timer_id, task_name, start_time, end_time, duration),
+            )
+            self._queue(
+                db, "timer", "create", timer_id,
+                {"task_name": task_name, "start_time": start_time, "end_time": end_time},
+            )
+        return timer_id
+
+    def stop_timer(self, timer_id, end_time):
+        with self.transaction() as db:
+            row = db.execute(
+                "SELECT task_name, start_time FROM timers WHERE id = ? AND end_time IS NULL", (timer_id,)
+            ).fetchone()
+            if row is None:
+                # Already stopped, here or by another client
+                return False
+            task_name, start_time = row
+            duration = int((datetime.fromisoformat(end_time) - datetime.fromisoformat(start_time)).total_seconds())
+            db.execute("UPDATE timers SET end_time = ?, duration = ? WHERE id = ?", (end_time, duration, timer_id))
+            if timer_id < 0:
+                # Not on the server yet, so it is created already stopped
+                self._queue(
+                    db, "timer", "create", timer_id,
+                    {"task_name": task_name, "start_time": start_time, "end_time": end_time},
+                )
+            else:
+                self._queue(db, "timer", "stop", timer_id, {"end_time": end_time})
+        return True
+
+    def _queue(self, db, entity, op, entity_id, payload):
+        # Repeated edits of one row collapse into the entry already queued
+        payload = json.dumps(payload)
+        updated = db.execute(
+            "UPDATE outbox SET payload = ? WHERE entity = ? AND entity_id = ? AND op = ?",
+            (payload, entity, entity_id, op),
+        ).rowcount
+        if not updated:
+            db.execute(
+                "INSERT INTO outbox (entity, op, entity_id, payload, idempotency_key) VALUES (?, ?, ?, ?, ?)",
+                (entity, op, entity_id, payload, uuid.uuid4().hex if op == "create" else None),
+            )
+
+    # Synchronization; runs on an API worker thread
+
+    def sync(self, api):
+        # Returns whether the local data changed. Overlapping calls return
+        # False straight away rather than pushing the same entries twice.
+        if not self.sync_lock.acquire(blocking=False):
+            return False
+        try:
+            pushed = self.push(api)
+            return self.pull(api) or pushed
+        finally:
+            self.sync_lock.release()
+
+    def push(self, api):
+        pushed = False
+        while True:
+            with self.lock:
+                batch = self.db.execute(
+                    "SELECT seq, entity, op, entity_id, payload, idempotency_key FROM outbox ORDER BY seq LIMIT ?",
+                    (OUTBOX_BATCH_SIZE,),
+                ).fetchall()
+            if not batch:
+                return pushed
+            pushed = True
+            entity, op = batch[0][1], batch[0][2]
+            if op == "create":
+                # Consecutive creates of one kind go out as a single bulk request
+                run = list(takewhile(lambda entry: entry[1] == entity and entry[2] == "create", batch))
+                if not self._push_creates(api, entity, run):
+                    return pushed
+            else:
+                self._push_update(api, batch[0])
+
+    def _push_creates(self, api, entity, entries):
+        # Returns False if the server asked for some entries to be resent;
+        # they stay queued for the next sync, keys and all
+        table = TABLES[entity][0]
+        result = api.create_many(entity, [dict(json.loads(entry[4]), idempotency_key=entry[5]) for entry in entries])
+        errors = {error["index"]: error for error in result["errors"]}
+        rejected = {index for index, error in errors.items() if not error.get("retry")}
+        accepted = [entry for index, entry in enumerate(entries) if index not in errors]
+        with self.transaction() as db:
+            # Swap the placeholder ids for the server's; the next pull then
+            # finds the rows already in place
+            for (seq, _, _, local_id, payload, _), server_id in zip(accepted, result["ids"]):
+                db.execute(f"UPDATE OR REPLACE {table} SET id = ? WHERE id = ?", (server_id, local_id))
+                # Edited while the request was in flight: send the new text
+                # as an update of the server row
+                db.execute(
+                    "UPDATE outbox SET op = 'update', entity_id = ? WHERE seq = ? AND payload != ?",
+                    (server_id, seq, payload),
+                )
+                self._settle(db, entity, server_id)
+            # The server will never accept these, so they are dropped rather
+            # than blocking the queue
+            for index in rejected:
+                db.execute(f"DELETE FROM {table} WHERE id = ?", (entries[index][3],))
+            db.executemany(
+                "DELETE FROM outbox WHERE seq = ? AND op = 'create'",
+                [(entry[0],) for index, entry in enumerate(entries) if index not in errors or index in rejected],
+            )
+        return len(rejected) == len(errors)
+
+    def _push_update(self, api, entry):
+        seq, entity, op, entity_id, payload, _ = entry
+        try:
+            if op == "stop":
+                api.stop_timer(entity_id, json.loads(payload)["end_time"])
+            else:
+                api.update(entity, entity_id, json.loads(payload))
+        except httpx.HTTPStatusError as e:
+            # 4xx, e.g. the row was deleted on the server: drop the entry and
+            # let the pull settle the row. Anything else is retried later.
+            if not e.response.is_client_error:
+                raise
+        with self.transaction() as db:
+            # Kept if edited again while the request was in flight
+            db.execute("DELETE FROM outbox WHERE seq = ? AND payload = ?", (seq, payload))
+            self._settle(db, entity, entity_id)
+
+    def _settle(self, db, entity, entity_id):
+        # Applies the change held back for a row once nothing is queued for
+        # it. That is the server's latest state of the row the pull has seen,
+        # e.g. the delete that made an update fail; a newer change, such as
+        # the one for an update just accepted, comes with a later pull.
+        row = db.execute("SELECT change FROM deferred WHERE entity = ? AND entity_id = ?", (entity, entity_id)).fetchone()
+        if row is None or self._queued(db, entity, entity_id):
+            return
+        db.execute("DELETE FROM deferred WHERE entity = ? AND entity_id = ?", (entity, entity_id))
+        self._apply(db, json.loads(row[0]))
+
+    def cursor(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM sync_state WHERE key = 'since'").fetchone()
+        return row[0] if row else 0
+
+    def pull(self, api):
+        changed = False
+        while True:
+            page = api.get_changes(self.cursor())
+            changed = self.apply(page["changes"], page["next"]) or changed
+            if not page["has_more"]:
+                return changed
+
+    def apply(self, changes, cursor):
+        # Shared by pull() and the live event stream, which may deliver the
+        # same changes in either order. Anything at or below the stored
+        # cursor has already been applied from an equal or newer read of
+        # the row, so it is skipped and the cursor never moves backwards.
+        with self.transaction() as db:
+            since = db.execute("SELECT value FROM sync_state WHERE key = 'since'").fetchone()
+            since = since[0] if since else 0
+            changes = [change for change in changes if change["seq"] > since]
+            for change in changes:
+                self._apply(db, change)
+            if cursor > since:
+                db.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('since', ?)", (cursor,))
+        return bool(changes)
+
+    def _queued(self, db, entity, entity_id):
+        return db.execute("SELECT 1 FROM outbox WHERE entity = ? AND entity_id = ?", (entity, entity_id)).fetchone()
+
+    def _apply(self, db, change):
+        table, columns = TABLES[change["entity"]]
+        if self._queued(db, change["entity"], change["id"]):
+            # Changes arrive in seq order, so this replaces an older one
+            db.execute(
+                "INSERT OR REPLACE INTO deferred (entity, entity_id, change) VALUES (?, ?, ?)",
+                (change["entity"], change["id"], json.dumps(change)),
+            )
+            return
+        if change["op"] == "delete":
+            db.execute(f"DELETE FROM {table} WHERE id = ?", (change["id"],))
+            return
+        data = change["data"]
+        db.execute(
+            f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            [data[column] for column in columns],
+        )